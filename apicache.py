@@ -0,0 +1,162 @@
+"""Conditional-request cache for GitHub API reads.
+
+Responses to GET requests are stored on disk together with their ETag and
+Last-Modified values, and are revalidated with conditional requests, so that an
+unchanged resource costs a 304 (which GitHub does not count against the rate
+limit) rather than a full payload. The cache sits underneath PyGithub, as the
+HTTP connection class used by its Requester."""
+
+import os, json, hashlib, threading, httplib
+
+class ApiCache(object):
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if not os.path.isdir(path): os.makedirs(path)
+        # url -> entry file name, so that invalidation does not need to read
+        # every entry
+        self.urls = {}
+        for name in os.listdir(path):
+            try:
+                self.urls[self.read(name)["url"]] = name
+            except (IOError, ValueError, KeyError):
+                os.remove(os.path.join(path, name))
+
+    def read(self, name):
+        f = open(os.path.join(self.path, name))
+        try:
+            return json.load(f)
+        finally:
+            f.close()
+
+    def load(self, url):
+        """Return the cached entry for the given url, or None."""
+        with self.lock:
+            name = self.urls.get(url)
+        if not name: return None
+        try:
+            return self.read(name)
+        except (IOError, ValueError):
+            return None
+
+    def store(self, url, headers, body):
+        """Store a response, if it can be revalidated later."""
+        validators = dict((k, v) for k, v in headers if k.lower() in ["etag", "last-modified"])
+        if not validators: return
+        name = hashlib.sha1(url).hexdigest()
+        entry_path = os.path.join(self.path, name)
+        tmp_path = "%s.%d.tmp" % (entry_path, threading.current_thread().ident)
+        f = open(tmp_path, "w")
+        try:
+            json.dump({"url": url, "headers": headers, "body": body}, f)
+        finally:
+            f.close()
+        os.rename(tmp_path, entry_path)
+        with self.lock:
+            self.urls[url] = name
+
+    def invalidate(self, prefix):
+        """Drop all entries whose url starts with the given prefix. Used after
+        the bot changes something on GitHub (comments, pushes, closing)."""
+        with self.lock:
+            names = [(url, name) for url, name in self.urls.items() if url.startswith(prefix)]
+            for url, name in names: del self.urls[url]
+        for url, name in names:
+            try:
+                os.remove(os.path.join(self.path, name))
+            except OSError:
+                pass
+
+    def record(self, hit):
+        with self.lock:
+            if hit: self.hits += 1
+            else: self.misses += 1
+
+    def reset_counters(self):
+        """Return the (hits, misses) counters, and reset them."""
+        with self.lock:
+            counters = self.hits, self.misses
+            self.hits = self.misses = 0
+        return counters
+
+class CachedResponse(object):
+    """Stand-in for an httplib response, whose body was already read."""
+    def __init__(self, status, headers, body):
+        self.status = status
+        self.reason = httplib.responses.get(status, "")
+        self.headers = headers
+        self.body = body
+
+    def getheaders(self):
+        return self.headers
+
+    def getheader(self, name, default=None):
+        for k, v in self.headers:
+            if k.lower() == name.lower(): return v
+        return default
+
+    def read(self):
+        return self.body
+
+def path_of(url):
+    return url.split("?", 1)[0]
+
+class CachingConnection:
+    """Mix-in for httplib connections, which serves GET requests through the
+    cache and invalidates cached entries on any other request. All requests
+    and responses are also reported to the rate limiter, if any."""
+    cache = None
+    rate_limiter = None
+
+    def request(self, method, url, body=None, headers={}):
+        self.cache_url = None
+        self.cache_entry = None
+        if self.rate_limiter: self.rate_limiter.request(method, url)
+        if self.cache and method == "GET":
+            self.cache_url = url
+            self.cache_entry = self.cache.load(url)
+            if self.cache_entry:
+                headers = dict(headers)
+                for k, v in self.cache_entry["headers"]:
+                    if k.lower() == "etag": headers["If-None-Match"] = v
+                    if k.lower() == "last-modified": headers["If-Modified-Since"] = v
+        elif self.cache:
+            self.cache.invalidate(path_of(url))
+        self.connection_class.request(self, method, url, body, headers)
+
+    def getresponse(self):
+        response = self.connection_class.getresponse(self)
+        if self.rate_limiter:
+            self.rate_limiter.response(response.status, response.getheaders())
+        if not self.cache_url: return response
+        if self.cache_entry and response.status == 304:
+            response.read()
+            self.cache.record(True)
+            # keep e.g. rate limit headers of the 304 up to date
+            fresh = dict((k.lower(), v) for k, v in response.getheaders())
+            headers = [(k, fresh.get(k.lower(), v)) for k, v in self.cache_entry["headers"]]
+            return CachedResponse(200, headers, self.cache_entry["body"])
+        self.cache.record(False)
+        if response.status != 200: return response
+        headers = response.getheaders()
+        body = response.read()
+        self.cache.store(self.cache_url, headers, body)
+        return CachedResponse(response.status, headers, body)
+
+class CachingHTTPConnection(CachingConnection, httplib.HTTPConnection):
+    connection_class = httplib.HTTPConnection
+
+class CachingHTTPSConnection(CachingConnection, httplib.HTTPSConnection):
+    connection_class = httplib.HTTPSConnection
+
+def install(path, rate_limiter=None):
+    """Create a cache in the given directory, and make PyGithub use it for all
+    its requests, reporting them to the given rate limiter."""
+    from github.Requester import Requester
+    cache = ApiCache(path)
+    CachingConnection.cache = cache
+    CachingConnection.rate_limiter = rate_limiter
+    Requester.injectConnectionClasses(CachingHTTPConnection, CachingHTTPSConnection)
+    return cache
@@ -0,0 +1,73 @@
+"""Content-addressed cache of build outputs.
+
+Outputs of a build step are stored as a tarball, keyed by the step and by
+everything the step depends on (the git tree hashes of the component
+repositories and the revision of the build tree's manifest). The cache is kept
+under a size limit by evicting the least recently used tarballs."""
+
+import os, hashlib, tarfile, threading
+
+class ArtifactCache(object):
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size # bytes
+        self.lock = threading.Lock()
+        if not os.path.isdir(path): os.makedirs(path)
+
+    def key(self, step, inputs):
+        """The key of the outputs of the given step, for the given inputs (a
+        list of strings, e.g. tree hashes)."""
+        return hashlib.sha1("\n".join([step] + sorted(inputs))).hexdigest()
+
+    def tarball(self, key):
+        return os.path.join(self.path, "%s.tar.gz" % key)
+
+    def restore(self, key, build_path):
+        """Extract the outputs stored under the given key into build_path.
+        Returns whether there were such outputs."""
+        tarball = self.tarball(key)
+        try:
+            os.utime(tarball, None) # mark as recently used
+            tar = tarfile.open(tarball)
+        except (OSError, IOError, tarfile.TarError):
+            return False
+        try:
+            tar.extractall(build_path)
+        finally:
+            tar.close()
+        return True
+
+    def store(self, key, build_path, outputs):
+        """Store the given outputs (paths relative to build_path) under the
+        given key, and evict old outputs if the cache is too big."""
+        tarball = self.tarball(key)
+        tmp_path = "%s.%d.tmp" % (tarball, threading.current_thread().ident)
+        tar = tarfile.open(tmp_path, "w:gz")
+        try:
+            for output in outputs:
+                if os.path.exists(os.path.join(build_path, output)):
+                    tar.add(os.path.join(build_path, output), output)
+        finally:
+            tar.close()
+        os.rename(tmp_path, tarball)
+        self.evict()
+
+    def evict(self):
+        with self.lock:
+            entries = []
+            for name in os.listdir(self.path):
+                if not name.endswith(".tar.gz"): continue
+                try:
+                    st = os.stat(os.path.join(self.path, name))
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, name))
+            entries.sort()
+            size = sum([e[1] for e in entries])
+            for mtime, entry_size, name in entries:
+                if size <= self.max_size: break
+                try:
+                    os.remove(os.path.join(self.path, name))
+                except OSError:
+                    pass
+                size -= entry_size
@@ -0,0 +1,419 @@
+"""Offline benchmark of the search for pull requests, against a simulated GitHub
+organisation.
+
+The github, settings and jiralib modules are replaced by fakes before main is
+imported, so that nothing is sent to GitHub (nor Jira). Every simulated request
+to GitHub waits for the given latency, and goes through the API cache and the
+rate limiter of the bot, as a real one would, but against a fake connection
+answering with the ETag of the resource (and a 304 if it did not change).
+Reports the wall time, the requests, the requests revalidated with a 304 and
+the requests spent against the rate limit, of the refreshes of privileges and
+of the searches (the first ones with nothing cached), of the indexing of
+comments, of should_rebuild and of dependencies_satisfied, and the peak memory
+of the process. Also checks that a pull request failing unexpectedly is retried
+once out of quarantine (exiting with 1 otherwise). Run e.g.:
+
+    python bench.py --repos 10 --prs 50 --comments 20 --latency 0.05
+"""
+
+import os, sys, json, time, types, random, hashlib, resource, tempfile, threading, argparse
+import apicache, ratelimit
+
+class Api(object):
+    """Counts the simulated requests, makes each of them take a while, and
+    sends them through the connection class injected into PyGithub."""
+    per_page = 30
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.connection_class = None # see install_fakes
+
+    def request(self, method, url, items=None, version=None):
+        """Simulate the request(s) to the given url, which returns the given
+        number of items (one page per per_page items) if it lists any. version
+        identifies the state of the resource, and gives its ETag."""
+        pages = 1
+        if items is not None: pages = max(1, (items + self.per_page - 1) / self.per_page)
+        with self.lock:
+            e = ratelimit.endpoint(method, url)
+            self.calls[e] = self.calls.get(e, 0) + pages
+        etag = None
+        if version is not None: etag = '"%s"' % hashlib.sha1(repr(version)).hexdigest()
+        for page in range(1, pages + 1):
+            page_url = url
+            if page > 1: page_url += "%spage=%d" % ("&" if "?" in url else "?", page)
+            if self.connection_class:
+                connection = self.connection_class(etag)
+                connection.request(method, page_url)
+                connection.getresponse().read()
+        if self.latency: time.sleep(self.latency * pages)
+
+    def reset(self):
+        """Return the number of requests made, and reset the counters."""
+        with self.lock:
+            total = sum(self.calls.values())
+            self.calls = {}
+        return total
+
+class FakeResponse(object):
+    def __init__(self, status, headers):
+        self.status = status
+        self.headers = headers
+
+    def getheaders(self):
+        return self.headers
+
+    def read(self):
+        return ""
+
+class FakeConnection(object):
+    """Stand-in for the HTTP connection to GitHub, which answers with the given
+    ETag, and with a 304 if the request is conditional on it."""
+    def __init__(self, etag):
+        self.etag = etag
+
+    def request(self, method, url, body=None, headers={}):
+        self.headers = headers
+
+    def getresponse(self):
+        if not self.etag: return FakeResponse(200, [])
+        if self.headers.get("If-None-Match") == self.etag: return FakeResponse(304, [])
+        return FakeResponse(200, [("ETag", self.etag)])
+
+class CachingFakeConnection(apicache.CachingConnection, FakeConnection):
+    connection_class = FakeConnection
+
+class GithubException(Exception):
+    def __init__(self, status, data):
+        Exception.__init__(self, status, data)
+        self.status = status
+        self.data = data
+
+class Obj(object):
+    def __init__(self, **attrs):
+        self.__dict__.update(attrs)
+
+class FakeIssue(object):
+    def __init__(self, api, url, comments):
+        self.api = api
+        self.url = url
+        self.comments = comments
+
+    def get_comments(self):
+        self.api.request("GET", "%s/comments" % self.url, len(self.comments),
+                         [c.id for c in self.comments])
+        return list(self.comments)
+
+    def create_comment(self, body):
+        self.api.request("POST", "%s/comments" % self.url)
+
+    def edit(self, **attrs):
+        self.api.request("PATCH", self.url)
+
+class FakeRepo(object):
+    def __init__(self, api, org_name, name):
+        self.api = api
+        self.name = name
+        self.url = "/repos/%s/%s" % (org_name, name)
+        self.owner = Obj(login=org_name)
+        self.pulls = {} # number -> pull request, open or not
+        self.comments = {} # number -> comments
+        self.branches = []
+
+    def get_pulls(self, state):
+        pulls = sorted([pr for pr in self.pulls.values() if pr.state == state],
+                       key=lambda pr: pr.number)
+        self.api.request("GET", "%s/pulls?state=%s" % (self.url, state), len(pulls),
+                         [(pr.number, pr.head.sha, pr.base.sha) for pr in pulls])
+        return pulls
+
+    def get_pull(self, number):
+        pr = self.pulls.get(number)
+        url = "%s/pulls/%d" % (self.url, number)
+        if not pr:
+            self.api.request("GET", url)
+            raise GithubException(404, {"message": "Not Found"})
+        head = getattr(pr, "head", None)
+        self.api.request("GET", url, version=(pr.state, pr.merged_at, head and head.sha))
+        return pr
+
+    def get_issue(self, number):
+        url = "%s/issues/%d" % (self.url, number)
+        self.api.request("GET", url, version=number)
+        return FakeIssue(self.api, url, self.comments.get(number, []))
+
+    def get_branches(self):
+        self.api.request("GET", "%s/branches" % self.url, len(self.branches),
+                         [(b.name, b.commit.sha) for b in self.branches])
+        return list(self.branches)
+
+class FakeTeam(object):
+    def __init__(self, api, name, permission, members):
+        self.api = api
+        self.id = id(self)
+        self.name = name
+        self.permission = permission
+        self.members = members
+
+    def get_members(self):
+        self.api.request("GET", "/teams/%d/members" % self.id, len(self.members),
+                         [m.login for m in self.members])
+        return list(self.members)
+
+class FakeOrg(object):
+    def __init__(self, api, name):
+        self.api = api
+        self.login = name
+        self.repos = {}
+        self.teams = []
+
+    def get_repo(self, name):
+        self.api.request("GET", "/repos/%s/%s" % (self.login, name), version=name)
+        return self.repos[name]
+
+    def get_teams(self):
+        self.api.request("GET", "/orgs/%s/teams" % self.login, len(self.teams),
+                         [(t.id, t.name, t.permission) for t in self.teams])
+        return list(self.teams)
+
+def random_sha(rnd):
+    return "%040x" % rnd.getrandbits(160)
+
+def make_org(api, options, org_name, bot_name, branches):
+    """Generate an organisation as described by the options. Pull requests are
+    new, already built with the current refs, or built with older refs, in
+    equal parts; some are approved, some depend on others."""
+    rnd = random.Random(options.seed)
+    org = FakeOrg(api, org_name)
+    users = [Obj(login="user%d" % i) for i in range(options.users)]
+    admins = users[:options.admins]
+    authors = users[:options.authors]
+    org.teams.append(FakeTeam(api, "Admins", "admin", admins))
+    org.teams.append(FakeTeam(api, "Authorised pull request authors", "pull", authors))
+    for i in range(max(options.teams - 2, 0)):
+        org.teams.append(FakeTeam(api, "Team %d" % i, "pull", rnd.sample(users, min(10, len(users)))))
+    comment_id = [0]
+    def comment(user, body):
+        comment_id[0] += 1
+        return Obj(id=comment_id[0], user=user, body=body)
+    bot = Obj(login=bot_name)
+    for r in range(options.repos):
+        repo = FakeRepo(api, org_name, "repo-%d" % r)
+        org.repos[repo.name] = repo
+        branch_shas = dict([(b, random_sha(rnd)) for b in branches])
+        repo.branches = [Obj(name=b, commit=Obj(sha=sha)) for b, sha in branch_shas.items()]
+        for n in range(1, options.prs + 1):
+            user = rnd.choice(users)
+            branch = rnd.choice(branches)
+            head = Obj(sha=random_sha(rnd), ref="feature-%d" % n,
+                       repo=Obj(name=repo.name, owner=user))
+            pr = Obj(number=n, user=user, title="CA-%d: change %d" % (rnd.randint(1, 99999), n),
+                     body="", state="open", merged_at=None,
+                     html_url="https://github.com/%s/%s/pull/%d" % (org_name, repo.name, n),
+                     head=head, base=Obj(ref=branch, repo=repo, sha=branch_shas[branch]))
+            repo.pulls[n] = pr
+            comments = [comment(rnd.choice(users), "Looks good to me.")
+                        for _ in range(options.comments)]
+            kind = n % 3 # 0: new, 1: built with the current refs, 2: with older refs
+            if kind:
+                head_sha = head.sha if kind == 1 else random_sha(rnd)
+                msg = "### %s/%s@%s &#8658; %s/%s@%s: Build succeeded." % (
+                    user.login, repo.name, head_sha, org_name, repo.name, branch_shas[branch])
+                comments.insert(rnd.randint(0, len(comments)), comment(bot, msg))
+            if rnd.random() < options.approved:
+                comments.append(comment(rnd.choice(admins), "@%s approved." % bot_name))
+            repo.comments[n] = comments
+        # pull requests merged before, for pull requests to depend on
+        for n in range(options.prs + 1, options.prs + 11):
+            repo.pulls[n] = Obj(number=n, state="closed", merged_at=time.time())
+    keys = [(name, n) for name in sorted(org.repos) for n in range(1, options.prs + 1)]
+    rnd.shuffle(keys)
+    deps = {}
+    # chains of open pull requests, each depending on the one before
+    for c in range(options.chains):
+        chain = keys[c * options.chain_length:(c + 1) * options.chain_length]
+        for key, dep in zip(chain[1:], chain):
+            deps.setdefault(key, []).append(dep)
+    # pull requests depending on merged ones
+    for key in keys[options.chains * options.chain_length:][:int(len(keys) * options.merged_deps)]:
+        deps.setdefault(key, []).append((key[0], options.prs + rnd.randint(1, 10)))
+    for (name, n), ds in deps.items():
+        org.repos[name].pulls[n].body = "Dependencies: %s" % ", ".join(
+            ["%d@%s" % (number, rep_name) for rep_name, number in ds])
+    return org
+
+def install_fakes(api, org, builds_path):
+    """Make the github, settings and jiralib modules importable by main. The
+    requests of the fake organisation go through the API cache once main
+    installs it."""
+    github = types.ModuleType("github")
+    github.GithubException = GithubException
+    class Github(object):
+        def __init__(self, login, password): pass
+        def get_organization(self, name): return org
+    github.Github = Github
+    requester = types.ModuleType("github.Requester")
+    class Requester(object):
+        @classmethod
+        def injectConnectionClasses(cls, http, https):
+            api.connection_class = CachingFakeConnection
+    requester.Requester = Requester
+    github.Requester = requester
+    settings = types.ModuleType("settings")
+    settings.builds_path = builds_path
+    settings.bot_email = "bot@example.com"
+    settings.bot_password = ""
+    settings.jira_url = None
+    jiralib = types.ModuleType("jiralib")
+    jiralib.jira = types.ModuleType("jiralib.jira")
+    sys.modules.update({"github": github, "github.Requester": requester,
+                        "settings": settings, "jiralib": jiralib,
+                        "jiralib.jira": jiralib.jira})
+
+class Quiet(object):
+    """Silence the output of the bot, unless verbose."""
+    def __init__(self, verbose):
+        self.verbose = verbose
+
+    def __enter__(self):
+        if self.verbose: return
+        self.stdout, self.stderr = sys.stdout, sys.stderr
+        sys.stdout = sys.stderr = open(os.devnull, "w")
+
+    def __exit__(self, type, value, traceback):
+        if self.verbose: return
+        sys.stdout.close()
+        sys.stdout, sys.stderr = self.stdout, self.stderr
+
+def timed(api, bot, func):
+    """Returns the wall time, the requests, the requests revalidated with a 304
+    and the requests spent against the rate limit, of func()."""
+    api.reset()
+    bot.api_cache.reset_counters()
+    bot.rate_limiter.end_cycle()
+    started = time.time()
+    func()
+    seconds = time.time() - started
+    hits, _ = bot.api_cache.reset_counters()
+    spent, _ = bot.rate_limiter.end_cycle()
+    return seconds, api.reset(), hits, spent
+
+def check_quarantine_retry(bot):
+    """Check that a pull request whose processing fails unexpectedly is left
+    alone while in quarantine, and is picked up again once its delay expired."""
+    def search():
+        bot.clear_state()
+        bot.request_full_search()
+        return [bot.item_key(item) for item in bot.get_pull_requests()]
+    items = [item for item in bot.get_pull_requests() if not item[2]]
+    if not items: return True
+    item = items[0]
+    delay = bot.quarantine.base_delay
+    merge_and_build = bot.merge_and_build
+    def fail(*args):
+        raise RuntimeError("simulated failure")
+    bot.quarantine.base_delay = 0.5
+    bot.merge_and_build = fail
+    try:
+        bot.run_job(*item)
+    finally:
+        bot.merge_and_build = merge_and_build
+        bot.quarantine.base_delay = delay
+    left_alone = bot.item_key(item) not in search()
+    time.sleep(0.6)
+    return left_alone and bot.item_key(item) in search()
+
+def run(options):
+    api = Api(options.latency)
+    builds_path = tempfile.mkdtemp(prefix="bench-")
+    # the org is generated before main is imported, as main connects at import
+    org = make_org(api, options, "xen-org", "xen-git", ["master", "tampa"])
+    install_fakes(api, org, builds_path)
+    os.chdir(os.path.dirname(os.path.abspath(__file__))) # for positive.txt
+    import main as bot
+    bot.active = False
+    bot.scan_workers = options.workers
+    bot.rep_names.clear()
+    bot.rep_names.update([(name, name) for name in org.repos])
+    results = [] # (name, seconds, requests, revalidated, spent)
+    with Quiet(options.verbose):
+        results.append(("refresh_privileges",) + timed(api, bot, bot.membership.refresh))
+        results.append(("refresh_privileges 2",) + timed(api, bot, bot.membership.refresh))
+        keys = [(name, n) for name, repo in org.repos.items()
+                for n, pr in repo.pulls.items() if pr.state == "open"]
+        rnd = random.Random(options.seed)
+        for cycle in range(options.cycles):
+            def search():
+                bot.clear_state()
+                if options.webhooks and cycle:
+                    for key in rnd.sample(keys, int(len(keys) * options.dirty)):
+                        bot.mark_dirty(key)
+                else:
+                    bot.request_full_search()
+                bot.get_next_pull_request()
+            results.append(("search %d" % (cycle + 1),) + timed(api, bot, search))
+        # pull requests considered by the searches, and their comments
+        prs = [pr for repo in org.repos.values() for pr in repo.pulls.values()
+               if pr.state == "open"]
+        comments = dict([((pr.base.repo.name, pr.number), pr.base.repo.comments[pr.number])
+                         for pr in prs])
+        def index_comments():
+            index = bot.CommentIndex(bot.bot_name)
+            for key, cs in comments.items():
+                index.update(key, cs).find_command(bot.positive_re, bot.membership.admins)
+        results.append(("index comments",) + timed(api, bot, index_comments))
+        def should_rebuild():
+            bot.clear_state()
+            for pr in prs:
+                state = bot.comment_index.states.get((pr.base.repo.name, pr.number))
+                if state: bot.should_rebuild(pr, state)
+        results.append(("should_rebuild",) + timed(api, bot, should_rebuild))
+        def dependencies_satisfied():
+            for pr in prs: bot.dependencies_satisfied((pr.base.repo.name, pr.number))
+        results.append(("dependencies_satisfied",) + timed(api, bot, dependencies_satisfied))
+        checks = {"quarantine retry": check_quarantine_retry(bot)}
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss # KB on Linux
+    if options.json:
+        print json.dumps({"options": vars(options), "max_rss_kb": max_rss, "checks": checks,
+                          "results": dict([(name, {"seconds": t, "requests": r,
+                                                   "revalidated": h, "spent": sp})
+                                           for name, t, r, h, sp in results])},
+                         indent=1, sort_keys=True)
+        return not [ok for ok in checks.values() if not ok]
+    print "%d repositories, %d open pull requests, %d comments each, %ss latency" % (
+        options.repos, len(prs), options.comments, options.latency)
+    print "%-24s %10s %10s %10s %10s" % ("", "seconds", "requests", "304s", "spent")
+    for name, t, r, h, sp in results:
+        print "%-24s %10.3f %10d %10d %10d" % (name, t, r, h, sp)
+    print "peak memory: %d KB" % max_rss
+    for name, ok in sorted(checks.items()):
+        print "%s: %s" % (name, "ok" if ok else "FAILED")
+    return not [ok for ok in checks.values() if not ok]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--repos", type=int, default=4)
+    parser.add_argument("--prs", type=int, default=20, help="open pull requests per repository")
+    parser.add_argument("--comments", type=int, default=10, help="comments per pull request")
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--admins", type=int, default=5)
+    parser.add_argument("--authors", type=int, default=40, help="trusted pull request authors")
+    parser.add_argument("--teams", type=int, default=5)
+    parser.add_argument("--approved", type=float, default=0.2, help="share of approved pull requests")
+    parser.add_argument("--chains", type=int, default=2, help="chains of dependent pull requests")
+    parser.add_argument("--chain-length", type=int, default=3)
+    parser.add_argument("--merged-deps", type=float, default=0.1,
+                        help="share of pull requests depending on a merged one")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds per request")
+    parser.add_argument("--workers", type=int, default=8, help="see scan_workers")
+    parser.add_argument("--cycles", type=int, default=3, help="searches to run")
+    parser.add_argument("--webhooks", action="store_true",
+                        help="searches after the first one are told what changed")
+    parser.add_argument("--dirty", type=float, default=0.1,
+                        help="share of pull requests changed between searches, with --webhooks")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    parser.add_argument("--verbose", action="store_true", help="show the bot's output")
+    sys.exit(0 if run(parser.parse_args()) else 1)
@@ -0,0 +1,78 @@
+"""Durable record of build attempts, keyed by the pull request's head SHA and
+the SHA of the branch it was merged into."""
+
+import sqlite3, threading, time
+
+SUCCEEDED = "succeeded"
+ERROR = "error" # failed unexpectedly, not because of the pull request
+BATCH_FAILED = "batch-failed" # failed together with others, before bisecting
+
+schema = """
+create table if not exists builds (
+    id integer primary key autoincrement,
+    repo text not null,
+    pr integer not null,
+    head_sha text not null,
+    base_sha text not null,
+    outcome text not null,
+    started real not null,
+    duration real,
+    log_path text,
+    source text not null default 'build'
+);
+create index if not exists builds_pair on builds (repo, head_sha, base_sha);
+create index if not exists builds_pr on builds (repo, pr);
+"""
+
+class BuildStore(object):
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        # the store can be shared by several instances, which wait for each
+        # other's writes
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript(schema)
+
+    def query(self, sql, args=()):
+        with self.lock:
+            return self.db.execute(sql, args).fetchall()
+
+    def record(self, repo, pr, head_sha, base_sha, outcome, started,
+               duration=None, log_path=None, source="build"):
+        """Record an attempt to merge and build the given pull request."""
+        with self.lock:
+            self.db.execute("insert into builds (repo, pr, head_sha, base_sha,"
+                            " outcome, started, duration, log_path, source)"
+                            " values (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                            (repo, pr, head_sha, base_sha, outcome, started,
+                             duration, log_path, source))
+            self.db.commit()
+
+    def last_build(self, repo, pr):
+        """Return the last recorded attempt for the given pull request, or
+        None. Attempts which failed unexpectedly, or as part of a batch, are left
+        out, so that the pull request is tried again."""
+        rows = self.query("select * from builds where repo = ? and pr = ?"
+                          " and outcome not in (?, ?) order by id desc limit 1",
+                          (repo, pr, ERROR, BATCH_FAILED))
+        if rows: return rows[0]
+
+    def has_succeeded(self, repo, pr):
+        """Whether any attempt for the given pull request succeeded."""
+        return bool(self.query("select 1 from builds where repo = ? and pr = ?"
+                               " and outcome = ? limit 1", (repo, pr, SUCCEEDED)))
+
+    def pair_succeeded(self, repo, head_sha, base_sha):
+        """Whether the bot itself successfully built the merge of head_sha into
+        base_sha. Records imported from comments are not trusted for this."""
+        return bool(self.query("select 1 from builds where repo = ?"
+                               " and head_sha = ? and base_sha = ? and outcome = ?"
+                               " and source = 'build' limit 1",
+                               (repo, head_sha, base_sha, SUCCEEDED)))
+
+    def import_comment(self, repo, pr, head_sha, base_sha, succeeded):
+        """Record the result of an attempt known only from a bot comment."""
+        outcome = SUCCEEDED if succeeded else "failed"
+        self.record(repo, pr, head_sha, base_sha, outcome, time.time(),
+                    source="comment")
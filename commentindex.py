@@ -0,0 +1,63 @@
+"""Incremental index of the bot's state and of the commands addressed to the bot,
+as parsed from the comments of pull requests.
+
+Each comment is parsed once: an update only looks at comments newer than the
+last comment seen for that pull request. Edits of already indexed comments are
+therefore not taken into account."""
+
+import re, time
+
+refs_re = re.compile("\S+?@\w+", re.U)
+
+class PullRequestState(object):
+    def __init__(self):
+        self.last_comment_id = 0
+        self.has_bot_comments = False
+        self.succeeded = False # whether any bot comment reported a build success
+        self.last_bot_refs = [] # refs from the first line of the last bot comment
+        self.commands = [] # (user, command) addressed to the bot, in order
+        self.comment_count = 0 # comments of the pull request at the last update
+        self.updated = 0 # time of the last update
+
+    def find_command(self, command_re, validators):
+        """Returns the first command posted by one of the validators which
+        matches the given compiled regular expression."""
+        for user, cmd in self.commands:
+            if user in validators and command_re.search(cmd):
+                return cmd
+
+class CommentIndex(object):
+    def __init__(self, bot_name):
+        self.bot_name = bot_name
+        self.mention_re = re.compile("@%s " % bot_name, re.I)
+        self.states = {}
+
+    def update(self, key, comments):
+        """Index the comments of the pull request identified by key, which
+        were not seen before, and return the pull request's state."""
+        state = self.states.setdefault(key, PullRequestState())
+        state.comment_count = len(comments)
+        state.updated = time.time()
+        for c in comments:
+            if c.id <= state.last_comment_id: continue
+            state.last_comment_id = c.id
+            self.parse(state, c.user.login, c.body)
+        return state
+
+    def parse(self, state, user, body):
+        if user == self.bot_name:
+            first_line = body.split("\n")[0]
+            state.has_bot_comments = True
+            state.last_bot_refs = refs_re.findall(first_line)
+            if first_line.find("Build succeeded.") != -1:
+                state.succeeded = True
+        m = self.mention_re.match(body)
+        if not m: return
+        cmds = body[m.end():].replace('!', '.').split('.')
+        state.commands.extend([(user, cmd.strip()) for cmd in cmds if cmd.strip()])
+
+    def retain(self, keys):
+        """Forget about all pull requests but the ones identified by keys."""
+        keys = set(keys)
+        for key in self.states.keys():
+            if key not in keys: del self.states[key]
@@ -0,0 +1,121 @@
+"""Graph of the dependencies between pull requests, across repositories.
+
+A pull request lists its dependencies in its description:
+   Dependencies: (<pr_number>@<rep_name_without_org_name>)*
+Multiple dependencies are separated by commas. Descriptions are only parsed
+again when they change. A pull request is identified by a (repository name,
+number) key."""
+
+import re
+
+dependencies_re = re.compile("dependenc(y|ies):(.*)", re.I)
+dependency_re = re.compile("([0-9]+)@(.*)")
+
+class DependencyGraph(object):
+    def __init__(self, rep_names):
+        self.rep_names = rep_names
+        self.bodies = {} # key -> description the dependencies were parsed from
+        self.deps = {} # key -> keys of the pull requests it depends on
+        self.errors = {} # key -> problem with its dependencies
+        self.reported = set() # (key, problem) pairs already reported
+        self.merged = set() # keys of pull requests known to be merged
+        self.open = set() # keys of the open pull requests
+        self.unmerged = set() # keys of closed pull requests not merged (this cycle)
+
+    def start_cycle(self, open_keys):
+        """Forget about pull requests which are no longer open, and about the
+        state of closed pull requests which were not merged (they could be
+        re-opened)."""
+        self.open = set(open_keys)
+        self.unmerged = set()
+        for key in self.bodies.keys():
+            if key not in self.open:
+                del self.bodies[key]
+                del self.deps[key]
+                self.errors.pop(key, None)
+        self.reported = set([(k, e) for k, e in self.reported if k in self.open])
+
+    def update(self, key, body):
+        """Parse the dependencies of the given pull request, if its description
+        changed."""
+        body = body or ""
+        if self.bodies.get(key) == body: return
+        self.bodies[key] = body
+        self.deps[key] = []
+        self.errors.pop(key, None)
+        m = dependencies_re.search(body)
+        if not m: return
+        for d in [d.strip() for d in m.group(2).strip().split(",") if d.strip()]:
+            dep_m = dependency_re.match(d)
+            if not dep_m:
+                self.errors[key] = "Could not parse dependency: %s" % d
+            elif dep_m.group(2) not in self.rep_names:
+                self.errors[key] = "Dependency on unknown depository: %s" % dep_m.group(2)
+            else:
+                self.deps[key].append((dep_m.group(2), int(dep_m.group(1))))
+
+    def find_cycle(self, start):
+        """Returns the keys on a dependency cycle through start, or []."""
+        path = [start]
+        def visit(key, seen):
+            for dep in self.deps.get(key, []):
+                if dep == start: return True
+                if dep in seen: continue
+                seen.add(dep)
+                path.append(dep)
+                if visit(dep, seen): return True
+                path.pop()
+            return False
+        if visit(start, set([start])): return path
+        return []
+
+    def satisfied(self, key, is_merged):
+        """Checks that all the pull requests the given pull request depends on
+        have been merged. Open pull requests are known not to be merged; for
+        the others, is_merged(key) is asked once (returning True, False, or None
+        if there is no such pull request), and merged ones are remembered."""
+        if self.error(key): return False
+        for dep in self.deps.get(key, []):
+            if dep in self.merged: continue
+            if dep in self.open or dep in self.unmerged: return False
+            merged = is_merged(dep)
+            if merged is None:
+                self.errors[key] = "Could not find dependency: %d@%s" % (dep[1], dep[0])
+                return False
+            if not merged:
+                self.unmerged.add(dep)
+                return False
+            self.merged.add(dep)
+        return True
+
+    def error(self, key):
+        """Returns the problem with the dependencies of the given pull request,
+        if any."""
+        if key in self.errors: return self.errors[key]
+        cycle = self.find_cycle(key)
+        if cycle:
+            return "Circular dependency: %s" % " -> ".join(
+                ["%d@%s" % (n, r) for r, n in cycle + [key]])
+
+    def new_error(self, key):
+        """Returns the problem with the dependencies of the given pull request,
+        unless it was returned before."""
+        error = self.error(key)
+        if error and (key, error) not in self.reported:
+            self.reported.add((key, error))
+            return error
+
+    def order(self, keys):
+        """Order the given keys so that pull requests come after the ones they
+        depend on, keeping the given order otherwise (and on cycles)."""
+        keys = list(keys)
+        pending = set(keys)
+        ordered = []
+        while keys:
+            ready = [k for k in keys
+                     if not [d for d in self.deps.get(k, []) if d in pending]]
+            key = (ready or keys)[0]
+            keys.remove(key)
+            pending.discard(key)
+            ordered.append(key)
+        return ordered
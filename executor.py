@@ -0,0 +1,104 @@
+"""Execution of shell commands on behalf of builds.
+
+Commands run in a given directory (without changing the working directory of
+the whole process), in their own process group, so that a command running for
+too long can be killed together with everything it started. Their output is
+streamed to a log file as it is printed, and the last lines printed in each
+thread are kept in memory, to be reported when something fails. The wall and
+CPU time of every command is recorded."""
+
+import os, signal, subprocess, threading, time, collections
+
+class Step(object):
+    """A command which was executed."""
+    def __init__(self, path, cmd, returncode, output, wall, cpu, timed_out):
+        self.path = path
+        self.cmd = cmd
+        self.returncode = returncode
+        self.output = output # what was printed to stdout, if captured
+        self.wall = wall # seconds
+        self.cpu = cpu # user and system seconds, including children
+        self.timed_out = timed_out
+
+class Executor(object):
+    def __init__(self, env, tail_lines):
+        """env: variables added to the environment of the commands; tail_lines:
+        number of lines kept in memory per thread."""
+        self.env = dict(os.environ, **env)
+        self.tail_lines = tail_lines
+        self.local = threading.local()
+
+    def start_job(self):
+        """Forget the output and the steps of the commands run before by the
+        current thread."""
+        self.local.tail = collections.deque(maxlen=self.tail_lines)
+        self.local.steps = []
+
+    def tail(self):
+        """The last lines printed by the commands run by the current thread."""
+        if not hasattr(self.local, "tail"): self.start_job()
+        return list(self.local.tail)
+
+    def steps(self):
+        """The commands run by the current thread since start_job."""
+        if not hasattr(self.local, "steps"): self.start_job()
+        return list(self.local.steps)
+
+    def run(self, path, cmd, log_path, timeout=None, capture=False):
+        """Run the given shell command in the given path, appending its output
+        to the given log (only its standard error if capture is set, standard
+        output being returned in the step then). The command and all its
+        children are killed after timeout seconds, if set. Returns a Step."""
+        if not hasattr(self.local, "tail"): self.start_job()
+        started = time.time()
+        devnull = open(os.devnull)
+        try:
+            p = subprocess.Popen(cmd, shell=True, cwd=path, env=self.env,
+                                 stdin=devnull, stdout=subprocess.PIPE,
+                                 stderr=subprocess.PIPE if capture else subprocess.STDOUT,
+                                 preexec_fn=os.setsid, close_fds=True)
+        finally:
+            devnull.close()
+        timed_out = []
+        def kill():
+            timed_out.append(True)
+            try:
+                os.killpg(p.pid, signal.SIGKILL)
+            except OSError:
+                pass
+        timer = None
+        if timeout is not None:
+            timer = threading.Timer(max(timeout, 0), kill)
+            timer.daemon = True
+            timer.start()
+        log = open(log_path, "a")
+        log_lock = threading.Lock()
+        tail = self.local.tail
+        def copy(stream):
+            for line in iter(stream.readline, ""):
+                with log_lock:
+                    log.write(line)
+                    log.flush()
+                    tail.append(line.rstrip("\n"))
+        try:
+            if capture:
+                errors = threading.Thread(target=copy, args=(p.stderr,))
+                errors.daemon = True
+                errors.start()
+                output = p.stdout.read()
+                errors.join()
+            else:
+                output = None
+                copy(p.stdout)
+            _, status, usage = os.wait4(p.pid, 0)
+        finally:
+            if timer: timer.cancel()
+            log.close()
+            p.stdout.close()
+            if capture: p.stderr.close()
+        if os.WIFSIGNALED(status): p.returncode = -os.WTERMSIG(status)
+        else: p.returncode = os.WEXITSTATUS(status)
+        step = Step(path, cmd, p.returncode, output, time.time() - started,
+                    usage.ru_utime + usage.ru_stime, bool(timed_out))
+        self.local.steps.append(step)
+        return step
@@ -0,0 +1,102 @@
+"""Leases shared by several instances of the bot, so that they do not process
+the same pull requests, nor push to the same branch at the same time.
+
+A lease is a name held by one instance until it expires. Leases are kept
+alive by a heartbeat, so that the leases of an instance which died expire
+after their TTL, and can then be claimed by the other instances. The store is
+an SQLite database, which all instances must be able to lock (e.g. on the same
+host, for testing)."""
+
+import sqlite3, threading, time
+from contextlib import contextmanager
+
+schema = """
+create table if not exists leases (
+    name text primary key,
+    owner text not null,
+    expires real not null
+);
+"""
+
+class LeaseStore(object):
+    def __init__(self, path, owner, ttl):
+        self.owner = owner
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.held = set() # names of the leases held by this instance
+        # transactions are started explicitly, to take the database's lock
+        # before reading the lease to claim
+        self.db = sqlite3.connect(path, timeout=30, isolation_level=None,
+                                  check_same_thread=False)
+        self.db.executescript(schema)
+
+    def claim(self, name):
+        """Claim the given lease, unless another instance holds it. Returns
+        whether this instance holds it."""
+        now = time.time()
+        with self.lock:
+            self.db.execute("begin immediate")
+            try:
+                row = self.db.execute("select owner, expires from leases where name = ?",
+                                      (name,)).fetchone()
+                if row and row[0] != self.owner and row[1] > now:
+                    return False
+                self.db.execute("insert or replace into leases values (?, ?, ?)",
+                                (name, self.owner, now + self.ttl))
+                self.held.add(name)
+                return True
+            finally:
+                self.db.execute("commit")
+
+    def release(self, name):
+        with self.lock:
+            self.held.discard(name)
+            self.db.execute("delete from leases where name = ? and owner = ?",
+                            (name, self.owner))
+
+    def renew(self):
+        """Extend all leases held by this instance, and forget about the ones
+        which expired and were claimed by others in the meantime."""
+        with self.lock:
+            self.db.execute("begin immediate")
+            try:
+                for name in list(self.held):
+                    if not self.db.execute("update leases set expires = ? where name = ?"
+                                           " and owner = ?", (time.time() + self.ttl,
+                                                              name, self.owner)).rowcount:
+                        self.held.discard(name)
+            finally:
+                self.db.execute("commit")
+
+    def holds(self, name):
+        """Whether this instance holds the given lease, and it has not expired
+        (as checked in the store)."""
+        with self.lock:
+            row = self.db.execute("select owner, expires from leases where name = ?",
+                                  (name,)).fetchone()
+            if row and row[0] == self.owner and row[1] > time.time(): return True
+            self.held.discard(name)
+            return False
+
+    def start_heartbeat(self, log):
+        """Renew the leases in a background thread, three times per TTL."""
+        def beat():
+            while True:
+                time.sleep(self.ttl / 3.0)
+                try:
+                    self.renew()
+                except sqlite3.Error as ex:
+                    log("Failed to renew leases: %s" % ex)
+        thread = threading.Thread(target=beat, name="lease-heartbeat")
+        thread.daemon = True
+        thread.start()
+
+    @contextmanager
+    def exclusive(self, name, poll):
+        """Hold the given lease for the body of a with statement, waiting for it
+        (checking every poll seconds) if another instance holds it."""
+        while not self.claim(name): time.sleep(poll)
+        try:
+            yield
+        finally:
+            self.release(name)
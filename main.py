@@ -1,6 +1,26 @@
-import re, os, time, traceback
+import re, os, time, traceback, threading, httplib, socket, zlib
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+from subprocess import CalledProcessError
 from watchdog import Watchdog
-from github import Github
+import apicache
+from ratelimit import RateLimiter
+from commentindex import CommentIndex
+from depgraph import DependencyGraph
+from membership import Membership
+import buildstore
+from workspace import WorkspacePool, WorkspaceError
+from scheduler import BuildScheduler
+from workqueue import WorkQueue
+from quarantine import Quarantine
+from lease import LeaseStore
+from mirror import MirrorCache, MirrorError
+from artifactcache import ArtifactCache
+from whitespace import WhitespaceVerifier, CommandTimedOut
+from executor import Executor
+from metrics import Metrics, MetricsServer
+from webhook import WebhookServer
+from github import Github, GithubException
 from jiralib import jira
 
 # switch, which determines whether any real actions are executed
@@ -8,7 +28,6 @@ active = True
 
 # set basic variables
 bot_name = "xen-git"
-tmp_branch = "%s-tmp" % bot_name
 import settings # bot_email, bot_api_token, builds_path
 org_name = "xen-org"
 rep_names = { # repository names to corresponding component names
@@ -17,10 +36,8 @@ rep_names = { # repository names to corresponding component names
     'xen-api': 'api',
     'xen-api-libs': 'api-libs',
     }
-build_dir = "build-%s.hg" % bot_name
 log_file = "build-%s.log" % bot_name
-log_path = "%s/%s" % (settings.builds_path, log_file)
-build_path = "%s/%s" % (settings.builds_path, build_dir)
+log_path = "%s/%s" % (settings.builds_path, log_file) # log of commands run outside of builds
 build_rep_prefix = "http://hg/carbon"
 branch_whitelist = { # valid GitHub branch -> local branch
     'master' : 'trunk-ring3',
@@ -30,156 +47,392 @@ branch_whitelist = { # valid GitHub branch -> local branch
     'sanibel-lcm' : 'sanibel-lcm',
     'tampa-lcm' : 'tampa-lcm'
     }
+# users who approve merges into a branch, instead of the administrators
+branch_validators = {
+    'tampa' : ['benchalmers'],
+    }
+pr_authors_team = "Authorised pull request authors"
+privileges_ttl = 600 # seconds, before the members of a team are fetched again
 short_sleep = 60 # seconds
+min_sleep = 15 # seconds, between searches while pull requests wait for a slot
 long_sleep = 600 # seconds
 resync_sleep = 300 # seconds
 fetch_timeout = 180 # seconds
-build_timeout = 1800 # seconds
+scan_workers = 8 # concurrent GitHub requests while scanning (1 = sequential)
+build_timeout = 1800 # seconds, per build
+command_timeout = 1800 # seconds, per command (within the build's timeout)
+error_log_lines = 20 # lines of the log of a failed build reported on GitHub
+build_workers = 4 # pull requests built at once, each in its own build tree
+# merge approved pull requests for the same branch together, building them once
+merge_queue = True
+max_batch_size = 8
+# outputs of the build steps (relative to the build tree), which are cached
+build_outputs = ["output"]
+artifact_cache_size = 20 * 1024 ** 3 # bytes
+whitespace_workers = 8 # files normalised at once when verifying whitespace changes
+# if a port is set, GitHub's webhook deliveries are received on it, and every
+# delivery starts a search; full searches are then only done as a safety net
+webhook_port = getattr(settings, "webhook_port", None)
+webhook_secret = getattr(settings, "webhook_secret", None)
+reconcile_sleep = 600 # seconds, between full searches when receiving webhooks
+# if a port is set, metrics are served on it (GET /metrics, for Prometheus);
+# they are also written to metrics_path after every search
+metrics_port = getattr(settings, "metrics_port", None)
+metrics_path = "%s/metrics-%s.json" % (settings.builds_path, bot_name)
+api_cycle_budget = 1500 # GitHub requests a search may spend
+api_reserve = 200 # GitHub requests always left for builds (comments, pushes..)
+api_page_size = 30 # items per page of GitHub's lists (PyGithub's default)
+# priority of the work items: base priority of merges and of (speculative)
+# builds, weighted by repository and by branch (default 1), plus the priority
+# an item gains for every minute it waits
+queue_priorities = {'merge': 100, 'build': 10}
+queue_aging = 1
+repo_weights = {}
+branch_weights = {}
+# a pull request whose processing fails unexpectedly is left alone for
+# quarantine_delay, doubled with every failure (up to quarantine_max_delay), and
+# until its head changes after quarantine_max_failures failures
+quarantine_delay = 300 # seconds
+quarantine_max_delay = 6 * 3600 # seconds
+quarantine_max_failures = 5
+# several instances of the bot can share the work: each instance only looks at
+# the (repository, branch) pairs of its shard (index, count), and claims the
+# pull requests it processes, and the branches it pushes to, through leases in
+# a store shared by all instances (lease_path), which expire after lease_ttl
+# unless renewed
+shard = getattr(settings, "shard", (0, 1))
+lease_path = getattr(settings, "lease_path", None)
+lease_ttl = 120 # seconds
+instance_name = "%s@%s:%d" % (bot_name, socket.gethostname(), os.getpid())
+# whether to build again before merging, when the bot already built the same
+# merge of the pull request into the branch (see README)
+rebuild_before_merge = True
 
 # result caches
 branch_sha_cache = {}
 
+# state of the build currently run by a thread: log_path, deadline, branch_sha
+job = threading.local()
+
+# set to start a search before the end of the sleep
+wakeup = threading.Event()
+# pull requests changed since the last search, as told by webhooks, or None if
+# the next search must fetch everything again
+dirty_prs = None
+dirty_prs_lock = threading.Lock()
+
+# pushes to a branch are serialised: (repository, branch) -> lock
+branch_locks = {}
+branch_locks_lock = threading.Lock()
+# after a push, merges into the branch wait for the local and GitHub
+# repositories to re-sync: (repository, branch) -> time until then
+resync_until = {}
+api_cache_path = "%s/api-cache-%s" % (settings.builds_path, bot_name)
+
+# outputs of earlier builds, by their inputs
+artifact_cache = ArtifactCache("%s/artifacts-%s" % (settings.builds_path, bot_name),
+                               artifact_cache_size)
+
+# durable record of build attempts, shared by all instances if leases are used
+# (lease_path)
+build_store = buildstore.BuildStore(lease_path or
+                                    "%s/builds-%s.db" % (settings.builds_path, bot_name))
+
+# pull requests waiting to be built or merged, and how long they waited
+work_queue = WorkQueue("%s/queue-%s.db" % (settings.builds_path, bot_name),
+                       queue_priorities, queue_aging, repo_weights, branch_weights)
+
+# timings of the phases of searches and builds, and other counters
+metrics = Metrics("pull_request_manager_")
+
+# runs the commands of the builds, and keeps the end of their output
+executor = Executor({"GIT_USER": bot_name}, error_log_lines)
+
+# pull requests failing unexpectedly, and when to retry them
+quarantine = Quarantine("%s/quarantine-%s.db" % (settings.builds_path, bot_name),
+                        quarantine_delay, quarantine_max_delay, quarantine_max_failures)
+# leases on pull requests and branches, if shared with other instances
+leases = None
+if lease_path: leases = LeaseStore(lease_path, instance_name, lease_ttl)
+
+# nothing is started before this time, after a fault which is not due to a
+# specific pull request
+paused_until = 0
+
 # prepare 'positive' and 'close' admin comment regular expression
 ls = [l.strip() for l in open("positive.txt").readlines() if l.strip()]
 positive = '|'.join(["(%s)" % l for l in ls])
+positive_re = re.compile(positive, re.I | re.U)
+check_re = re.compile("check", re.I | re.U)
+
+# parsed state of the comments of the open pull requests
+comment_index = CommentIndex(bot_name)
 
-# create an authenticating GitHub client
+# dependencies between pull requests, as stated in their descriptions
+dependency_graph = DependencyGraph(rep_names)
+
+# create an authenticating GitHub client, whose reads are revalidated against
+# an on-disk cache, and whose use of the rate limit is tracked
+rate_limiter = RateLimiter(api_cycle_budget, api_reserve)
+api_cache = apicache.install(api_cache_path, rate_limiter)
 github = Github(bot_name, settings.bot_password)
 org = github.get_organization(org_name)
 
-def refresh_privileges():
-    """Figure out who can approve a request (admin_usernames), and whose pull
-    requests are considered (pr_usernames)."""
-    log("Refreshing privileges..")
-    global admin_usernames, pr_usernames
-    teams = org.get_teams()
-    admin_teams = [t for t in teams if t.permission in ["admin", "push"]]
-    admins = sum([list(team.get_members()) for team in admin_teams], [])
-    admin_usernames = [admin.login for admin in admins]
-    pr_team_ids = [t for t in teams if t.name == "Authorised pull request authors"]
-    pr_users = sum([list(team.get_members()) for team in pr_team_ids], [])
-    pr_usernames = [pr_user.login for pr_user in pr_users]
-    pr_usernames.extend(admin_usernames)
+def parallel_map(func, items):
+    """Apply func to each of the given items using up to scan_workers threads,
+    and return the results in the order of the items."""
+    items = list(items)
+    if scan_workers <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+    pool = ThreadPool(min(scan_workers, len(items)))
+    try:
+        # a timeout keeps the main thread responsive to the Watchdog's SIGALRM
+        return pool.map_async(func, items).get(fetch_timeout)
+    finally:
+        pool.terminate()
+        pool.join()
 
-def get_next_pull_request():
-    """Performs a fresh search, and obtains the next pull request to process,
-    whether a re-build is required for this pull request, whether the pull
-    request should be merged, and what (if any) ticket to close."""
-    log("Searching for pull request to process..")
-    backup_pr = None
+def in_shard(rep_name, branch):
+    """Whether pull requests to the given branch are processed by this
+    instance."""
+    index, count = shard
+    return zlib.crc32("%s/%s" % (rep_name, branch)) % count == index
+
+def fetch_repository(rep_name):
+    """Obtain the given repository and all its open pull requests."""
+    repo = org.get_repo(rep_name)
+    return repo, list(repo.get_pulls("open"))
+
+def fetch_comments(rep_pr):
+    """Obtain all comments of the given (repository, pull request) pair."""
+    repo, pr = rep_pr
+    # Strange bug in github api, comments are in issues.
+    return list(repo.get_issue(pr.number).get_comments())
+
+def fetch_cost(key):
+    """The requests fetch_comments is expected to spend on the pull request
+    identified by key: one for the issue, and one per page of the comments it
+    had when last indexed (one page if not indexed yet)."""
+    state = comment_index.states.get(key)
+    comments = state.comment_count if state else 0
+    return 1 + max(1, (comments + api_page_size - 1) / api_page_size)
+
+def take_dirty_prs():
+    """Returns the pull requests changed since the last search (None meaning
+    all), and starts collecting them anew."""
+    global dirty_prs
+    with dirty_prs_lock:
+        dirty = dirty_prs
+        dirty_prs = set()
+    return dirty
+
+def request_full_search():
+    global dirty_prs
+    with dirty_prs_lock:
+        dirty_prs = None
+
+def mark_dirty(key):
+    with dirty_prs_lock:
+        if dirty_prs is not None: dirty_prs.add(key)
+
+def handle_event(event, payload):
+    """Update the state according to the given webhook delivery, and start a
+    new search."""
+    if event in ["membership", "team"]:
+        log("EVENT: %s on team %s" % (event, payload["team"]["name"]))
+        membership.invalidate(payload["team"]["id"])
+        return
+    if event not in ["pull_request", "issue_comment", "push"]: return
+    rep_name = payload["repository"]["name"]
+    if rep_name not in rep_names: return
+    log("EVENT: %s on %s" % (event, rep_name))
+    if event == "push":
+        branch = payload["ref"].split("/", 2)[-1]
+        branch_sha_cache.pop(("%s/%s" % (org_name, rep_name), branch), None)
+        invalidate_cached_branches(rep_name)
+    else:
+        number = payload.get("pull_request", payload.get("issue"))["number"]
+        invalidate_cached_pull_request(rep_name, number)
+        mark_dirty((rep_name, number))
+    wakeup.set()
+
+def get_pull_requests():
+    """Performs a fresh search, and obtains the pull requests to process, in the
+    order they should be processed. For each pull request, also obtains whether
+    a re-build is required, whether the pull request should be merged, what (if
+    any) ticket to close, and whether to send a notification."""
+    log("Searching for pull requests to process..")
+    # fetch all repositories with their open pull requests, and then the
+    # comments of all these pull requests (once per pull request)
+    rep_list = list(rep_names)
+    with metrics.timer("scan_phase_seconds", "fetch_repositories"):
+        repos = parallel_map(fetch_repository, rep_list)
+    repos = [(repo, [pr for pr in all_prs if in_shard(repo.name, pr.base.ref)])
+             for repo, all_prs in repos]
+    rep_prs = [(repo, pr) for repo, all_prs in repos for pr in all_prs]
+    keys = [(repo.name, pr.number) for repo, pr in rep_prs]
+    quarantine.retain(dict([(key, pr.head.sha) for key, (repo, pr) in zip(keys, rep_prs)]))
+    # pull requests waiting for others to be merged are not looked at further
+    with metrics.timer("scan_phase_seconds", "dependencies"):
+        dependency_graph.start_cycle(keys)
+        for key, (repo, pr) in zip(keys, rep_prs): dependency_graph.update(key, pr.body)
+        blocked = set([key for key in keys if not dependencies_satisfied(key)])
+    # neither are pull requests in quarantine
+    for key, (repo, pr) in zip(keys, rep_prs):
+        if quarantine.is_quarantined(key, pr.head.sha):
+            log("QUARANTINED: %s/%d" % key)
+            blocked.add(key)
+    # when receiving webhooks, only fetch the comments of pull requests which
+    # changed or are not indexed yet
+    dirty = take_dirty_prs()
+    fetch = [(key, rep_pr) for key, rep_pr in zip(keys, rep_prs) if key not in blocked
+             and (dirty is None or key in dirty or key not in comment_index.states)]
+    # within the request budget, pull requests not indexed yet first, then the
+    # ones indexed the longest ago, so that deferred ones come first next time;
+    # the others keep their last known state until the next search
+    fetch.sort(key=lambda item: getattr(comment_index.states.get(item[0]), "updated", 0))
+    allowance = rate_limiter.allowance()
+    affordable = 0
+    for key, _ in fetch:
+        allowance -= fetch_cost(key)
+        if allowance < 0: break
+        affordable += 1
+    if affordable < len(fetch):
+        log("REQUEST BUDGET: deferring comments of %d pull requests" % (len(fetch) - affordable))
+        for key, _ in fetch[affordable:]: mark_dirty(key)
+        fetch = fetch[:affordable]
+    states = dict([(key, comment_index.states.get(key)) for key in keys])
+    with metrics.timer("scan_phase_seconds", "fetch_comments"):
+        comments = parallel_map(fetch_comments, [rep_pr for _, rep_pr in fetch])
+    metrics.inc("comments_fetched_total", len(fetch))
+    states.update([(key, comment_index.update(key, c)) for (key, _), c in zip(fetch, comments)])
+    comment_index.retain(keys)
+    approved = []
+    changed_prs = []
     # for each repository
-    for rep_name in rep_names:
-        # get repository path
-        repo = org.get_repo(rep_name)
-        # fetch all open pull requests for this repository
-        all_prs = repo.get_pulls("open")
+    for rep_name, (repo, all_prs) in zip(rep_list, repos):
         # select only pull requests by trusted users
         valid_prs = [pr for pr in all_prs
-                     if pr.user.login in pr_usernames
+                     if membership.is_author(pr.user.login)
                      and pr.base.ref in branch_whitelist]
         # Select pull requests which are not made by trusted users,
         # but which 1) have comments 2) made by admin users 3) which
         # contain the text '@xen-git check' in the comment body.
         for pr in set(all_prs) - set(valid_prs):
-            # Strange bug in github api, comments are in issues.
-            issue = repo.get_issue(pr.number)
-            comments = issue.get_comments()
-            if search_comments(comments, "check",admin_usernames):
+            if (repo.name, pr.number) in blocked: continue
+            state = states[(repo.name, pr.number)]
+            if state and state.find_command(check_re, membership.admins):
                 valid_prs.append(pr)
-        # if a pull request contains a specific comment, chose it immediately
-        # otherwise, choose a pull request with no comments from bot or whose
-        # refs have changed
+        # pull requests with a specific comment come first, followed by pull
+        # requests with no comments from bot or whose refs have changed
         for valid_pr in valid_prs:
-            # Strange bug in github api, comments are in issues.
-            issue = repo.get_issue(valid_pr.number)
-            comments = issue.get_comments()
-            succeeded, new_pr, changed = should_rebuild(valid_pr, comments)
-            send_notification = new_pr
-            validators = admin_usernames
-            if valid_pr.base.ref == "tampa": validators = ['benchalmers']
-            # check if an admin approved it, and its last attempt to build it
-            # was successful or refs have changed
-            if (succeeded or changed) and search_comments(comments, positive,validators):
-                log("APPROVED: %s/%d" % (rep_name, valid_pr.number))
-                ticket = search_title_for_key(valid_pr)
-                log("TICKET: %s" % ticket)
-                return valid_pr, True, True, ticket, send_notification # rebuild, merge, to close
-            # otherwise, check if it should be processed anyway
-            if changed: backup_pr = valid_pr
-    return backup_pr, True, False, None, send_notification # rebuild, don't merge, don't close
-
-def search_comments(comments, search_re,validators):
-    """Checks whether any comment of a pull request starts with "@xen-git",
-    and one of its parts (parts are delimited by '.' or '!') starts with the
-    given regular expression (case ignored)."""
-    for c in comments:
-        if c.user.login not in validators: continue
-        m = re.match("@%s " % bot_name, c.body, re.I)
-        if not m: continue
-        cmds = c.body[m.end():].replace('!', '.').split('.')
-        cmds = [cmd.strip() for cmd in cmds if cmd.strip()]
-        for cmd in cmds:
-            if re.search(search_re, cmd, re.I | re.U):
-                return cmd
-
-def dependencies_satisfied(pr, rep_name):
-    """Checks that all the pull requests that this pull request depends on have
-    been merged. The format for specifying dependencies is:
-       Dependencies: (<pr_number>@<rep_name_without_org_name>)*
-    Multiple dependencies are separated by commas."""
-    m = re.search("dependenc(y|ies):(.*)", pr.body, re.I)
-    if not m: return True
-    deps = [d.strip() for d in m.group(2).strip().split(",") if d.strip()]
-    for d in deps:
-        dep_pr_m = re.match("([0-9]+)@(.*)", d)
-        if not dep_pr_m:
-            report_error(pr, "Could not parse dependency: %s" % d, False)
-            return False
-        dep_pr_no = dep_pr_m.group(1)
-        dep_pr_rep = dep_pr_m.group(2)
-        if dep_pr_rep not in rep_names:
-            report_error(pr, "Dependency on unknown depository: %s" % dep_pr_rep, False)
-            return False
-        dep_pr = None
-        try:
-            dep_pr = org.get_repo(dep_pr_rep).get_pull(int(dep_pr_no))
-        except:
-            report_error(pr, "Could not find dependency: %s" % d, False)
-            return False
-        if not hasattr(dep_pr, "merged_at"):
-            log("DEPENDENCY NOT MERGED: %s for %s/%d" % (d, rep_name, pr.number))
-            return False
-    return True
+            key = (repo.name, valid_pr.number)
+            if key in blocked:
+                error = dependency_graph.new_error(key)
+                if error: report_error(valid_pr, error, False)
+                continue
+            state = states[key]
+            if not state: continue # comments not fetched yet
+            try:
+                item = evaluate_pull_request(valid_pr, state)
+            except Exception as ex:
+                if is_global_fault(ex): raise
+                traceback.print_exc()
+                quarantine_failure(valid_pr, ex)
+                continue
+            if not item: continue
+            if item[2]: approved.append(item)
+            else: changed_prs.append(item)
+    # the most recently found changed pull request used to be processed first
+    changed_prs.reverse()
+    return order_items(approved) + order_items(changed_prs)
 
-def succeeded_comment(comments):
-    for c in comments:
-        first_line = c.body.split("\n")[0]
-        if (first_line.find("Build succeeded.") != -1):
-            return True
+def evaluate_pull_request(pr, state):
+    """Returns the work item for the given pull request, given the indexed
+    state of its comments, or None if there is nothing to do."""
+    succeeded, new_pr, changed = should_rebuild(pr, state)
+    send_notification = new_pr
+    validators = membership.validators(pr.base.ref)
+    # check if an admin approved it, and its last attempt to build it
+    # was successful or refs have changed
+    if (succeeded or changed) and state.find_command(positive_re, validators):
+        log("APPROVED: %s/%d" % (pr.base.repo.name, pr.number))
+        ticket = search_title_for_key(pr)
+        log("TICKET: %s" % ticket)
+        return pr, True, True, ticket, send_notification # rebuild, merge, to close
+    # otherwise, check if it should be processed anyway
+    if changed:
+        return pr, True, False, None, send_notification # rebuild, don't merge, don't close
+
+def item_key(item):
+    """The (repository name, number) key of the pull request of a work item."""
+    pr = item[0]
+    return pr.base.repo.name, pr.number
+
+def order_items(items):
+    """Order the given work items topologically by their dependencies."""
+    by_key = dict([(item_key(item), item) for item in items])
+    return [by_key[key] for key in dependency_graph.order(map(item_key, items))]
+
+def prioritise(items):
+    """Queue the given work items, and return them in the order of their
+    priority (see workqueue), pull requests still coming after the ones they
+    depend on. Items for the same head SHA and branch as an item coming before
+    are left out."""
+    work_queue.sync([(pr.base.repo.name, pr.number, pr.base.ref, pr.head.sha,
+                      "merge" if merge else "build") for pr, _, merge, _, _ in items])
+    by_key = dict([(item_key(item), item) for item in items])
+    return order_items([by_key[key] for key in work_queue.ordered() if key in by_key])
+
+def get_next_pull_request():
+    """Obtains the next pull request to process, whether a re-build is required
+    for this pull request, whether the pull request should be merged, and what
+    (if any) ticket to close."""
+    items = prioritise(get_pull_requests())
+    if items: return items[0]
+    return None, True, False, None, False
+
+def is_merged(key):
+    """Whether the pull request identified by the given (repository name,
+    number) key was merged, or None if there is no such pull request."""
+    rep_name, number = key
+    try:
+        pr = org.get_repo(rep_name).get_pull(number)
+    except GithubException as ex:
+        if ex.status == 404: return None
+        raise
+    return pr.merged_at is not None
+
+def dependencies_satisfied(key):
+    """Checks that all the pull requests that the pull request identified by
+    the given key depends on have been merged (see depgraph)."""
+    if dependency_graph.satisfied(key, is_merged): return True
+    log("DEPENDENCY NOT SATISFIED: %s/%d" % key)
     return False
 
-def should_rebuild(pr, comments):
-    """Checks the pull requests and its comments to see whether the pull request
-    has succeeded the last time, and whether the refs have changed."""
+def should_rebuild(pr, state):
+    """Checks the pull requests and the indexed state of its comments to see
+    whether the pull request has succeeded the last time, and whether the refs
+    have changed. The pull request's dependencies must have been checked."""
     rep_name = pr.base.repo.name
-    if not dependencies_satisfied(pr, rep_name):
-        return False, False, False
-    # approve if no existing bot comments
-    bot_comments = [c for c in comments if c.user.login == bot_name]
-    if not bot_comments:
+    last_build = build_store.last_build(rep_name, pr.number)
+    if not last_build and state.has_bot_comments:
+        # import the last attempt from the bot's comments
+        refs = state.last_bot_refs
+        head_sha = refs[0].split("@")[-1]
+        base_sha = refs[1].split("@")[-1]
+        build_store.import_comment(rep_name, pr.number, head_sha, base_sha, state.succeeded)
+        last_build = build_store.last_build(rep_name, pr.number)
+    # approve if no earlier attempts
+    if not last_build:
         log("NO COMMENTS: %s/%d" % (rep_name, pr.number))
         return False, True, True # "last build not succeeded", "refs changed"
-    # otherwise, parse last bot's comment, and check for ref changes
-    succeeded = succeeded_comment(bot_comments)
-    last_bot_comment = bot_comments[-1]
-    first_line = last_bot_comment.body.split("\n")[0]
-    refs = re.findall("\S+?@\w+", first_line, re.U)
-    last_pr_ref = refs[0]
-    last_branch_ref = refs[1]
-    current_pr_ref = get_pr_ref(pr)
+    # otherwise, check for ref changes since the last attempt
+    succeeded = build_store.has_succeeded(rep_name, pr.number)
     branch = pr.base.ref
-    current_branch_ref = get_branch_ref(rep_name, branch)
-    changed = last_pr_ref != current_pr_ref or last_branch_ref != current_branch_ref
+    current_branch_sha = get_cached_branch_sha(rep_name, branch)
+    changed = (last_build["head_sha"] != pr.head.sha
+               or last_build["base_sha"] != current_branch_sha)
     if changed: log("REFS CHANGED: %s/%d" % (rep_name, pr.number))
     return succeeded, False, changed
 
@@ -189,22 +442,18 @@ def report_error(pr, ex_msg, show_log):
     rep_name = pr.base.repo.name
     pr_ref = get_pr_ref(pr)
     branch = pr.base.ref
-    branch_ref = get_branch_ref(rep_name, branch)
+    branch_ref = get_branch_ref(rep_name, branch, getattr(job, "branch_sha", None))
     prefix = bot_msg_prefix(pr_ref, branch_ref)
     msg = "%s Merge and build failed.\n%s" % (prefix, ex_msg)
     if show_log:
         msg += "\nError log:"
-        f = open(log_path)
-        lines = f.readlines()
-        f.close()
-        linesToPrint = min(20, len(lines))
-        firstLineToPrint = len(lines) - linesToPrint
-        for i in range(firstLineToPrint, firstLineToPrint + linesToPrint):
-            msg += "\n    %s" % lines[i].rstrip()
+        for line in executor.tail():
+            msg += "\n    %s" % line.rstrip()
     print_msg(pr, msg)
     if active:
         issue = pr.base.repo.get_issue(pr.number)
         issue.create_comment(msg.replace('%','_')) # PyGithub doesn't like % character.
+        invalidate_cached_pull_request(rep_name, pr.number)
 
 def bot_msg_prefix(pr_ref, branch_ref):
     return "### %s &#8658; %s:" % (pr_ref, branch_ref)
@@ -216,24 +465,48 @@ def print_msg(pr, msg):
     print "Pull request: %s\n%s" % (pr.html_url, msg)
     print "============================="
 
-def execute(path, cmd):
-    """Execute the given command in the given path."""
-    cwd = os.getcwd()
-    os.chdir(path)
+def current_log_path():
+    """The log of the build run by the current thread, if any."""
+    return getattr(job, "log_path", log_path)
+
+def command_timeout_for(cmd):
+    """The time the given command may take: command_timeout, within the
+    deadline of the current build, if any."""
+    timeout = command_timeout
+    deadline = getattr(job, "deadline", None)
+    if deadline:
+        timeout = min(timeout, int(deadline - time.time()))
+        if timeout <= 0:
+            raise BuildError("Timed out before executing:\n    %s" % cmd)
+    return timeout
+
+def run_command(path, cmd, capture):
+    """Run the given command in the given path (see executor), and log how long
+    it took."""
     log("Executing '%s' in '%s' ..." % (cmd, path))
-    retcode = os.system("GIT_USER=%s %s 2>&1 >> %s" % (bot_name, cmd, log_path))
-    os.chdir(cwd)
-    return retcode
+    timeout = command_timeout_for(cmd)
+    step = executor.run(path, cmd, current_log_path(), timeout, capture)
+    if step.timed_out:
+        log("Timed out after %ds: '%s'" % (timeout, cmd))
+    log("Executed '%s' in %.1fs (%.1fs CPU), exit code %d."
+        % (cmd, step.wall, step.cpu, step.returncode))
+    command = " ".join(cmd.split()[:2]) # e.g. "make manifest-latest"
+    metrics.observe("command_seconds", step.wall, command=command)
+    metrics.observe("command_cpu_seconds", step.cpu, command=command)
+    if step.timed_out: metrics.inc("command_timeouts_total", command=command)
+    return step
+
+def execute(path, cmd):
+    """Execute the given command in the given path, and return its exit code."""
+    return run_command(path, cmd, False).returncode
 
 def execute_and_return(path, cmd):
     """Execute the given command in the given path, and return whatever was
     printed to stdout."""
-    cwd = os.getcwd()
-    os.chdir(path)
-    log("Executing '%s' in '%s' ..." % (cmd, path))
-    output = os.popen("GIT_USER=%s %s" % (bot_name, cmd)).read()
-    os.chdir(cwd)
-    return output
+    step = run_command(path, cmd, True)
+    if step.timed_out:
+        raise BuildError("Timed out when executing:\n    %s" % cmd)
+    return step.output
 
 class BuildError(Exception):
     def __init__(self, message):
@@ -244,7 +517,10 @@ class BuildError(Exception):
 def execute_and_report(path, cmd):
     """Execute the given command in the given path, raising an exception for a
     non-zero return code."""
-    if execute(path, cmd) != 0:
+    step = run_command(path, cmd, False)
+    if step.timed_out:
+        raise BuildError("Timed out when executing:\n    %s" % cmd)
+    if step.returncode != 0:
         raise BuildError("Failed when executing:\n    %s" % cmd)
 
 class MergeError(Exception):
@@ -259,43 +535,21 @@ class VerificationError(Exception):
     def __str__(self):
         return self.message
 
-def obtain_normalised_shas(rep_dir, src_files, ref):
-    shas = dict()
-#    execute_and_report(rep_dir, "git checkout -B %s %s" % (tmp_branch, ref))
-    execute_and_report(rep_dir, "git branch -f %s %s" % (tmp_branch, ref))
-    execute_and_report(rep_dir, "git checkout %s" % tmp_branch)
-    for src_file in src_files:
-        camlp4_cmd = "camlp4 -parser o -printer o -no_comments %s | md5sum" % src_file
-        shas[src_file] = execute_and_return(rep_dir, camlp4_cmd).split()[0]
-    execute_and_report(rep_dir, "git checkout master")
-    return shas
-
 def verify_whitespace_changes(rep_dir, pr):
     log("Verifying whitespace changes..")
-    checked = False
-    execute_and_report(rep_dir, "git checkout master")
-    prev = pr.base.sha
-    log_range = "%s..%s" % (pr.base.sha, pr.head.sha)
-    log_cmd = "git log --reverse --pretty=oneline %s" % log_range
-    out = execute_and_return(rep_dir, log_cmd)
-    for line in out.split("\n"):
-        if line == "": continue
-        parts = line.split(" ", 1)
-        curr = parts[0]
-        comment = parts[1]
-        if re.match("\[?(indentation|whitespace)", comment, re.I):
-            files_cmd = "git show --pretty=\"format:\" --name-only %s" % curr
-            out = execute_and_return(rep_dir, files_cmd)
-            src_files = [f for f in out.split("\n") if re.match(".+\.ml[i]?", f)]
-            prev_shas = obtain_normalised_shas(rep_dir, src_files, prev)
-            curr_shas = obtain_normalised_shas(rep_dir, src_files, curr)
-            for src_file in src_files:
-                if prev_shas[src_file] != curr_shas[src_file]:
-                    ref = get_pr_ref(pr, curr)
-                    msg = "Whitespace check failed for %s at %s." % (src_file, ref)
-                    raise VerificationError(msg)
-            checked = True
-        prev = curr
+    timeout = command_timeout_for("whitespace check")
+    try:
+        checked, failure = whitespace_verifier.verify(rep_dir, pr.base.sha, pr.head.sha,
+                                                      timeout, current_log_path())
+    except CalledProcessError as ex:
+        raise BuildError("Failed when executing:\n    %s" % ex.cmd)
+    except CommandTimedOut as ex:
+        raise BuildError("Timed out after %ds when executing:\n    %s" % (timeout, ex.cmd))
+    if failure:
+        src_file, curr = failure
+        ref = get_pr_ref(pr, curr)
+        msg = "Whitespace check failed for %s at %s." % (src_file, ref)
+        raise VerificationError(msg)
     return checked
 
 def search_title_for_key(pr):
@@ -320,101 +574,413 @@ def create_jira_issue(pr,assignee):
     if origin: ticket.linkIssue(origin,"contains")
     return ticket.getKey()
 
-def process_pull_request(pr, rebuild_required, merge, ticket, send_notification):
+def process_pull_request(pr, rebuild_required, merge, ticket, send_notification,
+                         branch_sha=None):
     """If a rebuild is required, try building the system with the changesets
     from the given pull request. If the build succeeds and the merge has been
     requested, merge the pull request with the main repository. Also close the
-    Jira ticket if merged and a ticket is specified."""
+    Jira ticket if merged and a ticket is specified. The attempt is recorded in
+    the build store, and a rebuild is skipped if the bot already built the same
+    merge successfully. The pull request is merged into the branch at
+    branch_sha, which defaults to the branch's current SHA."""
+    rep_name = pr.base.repo.name
+    if not branch_sha: branch_sha = get_cached_branch_sha(rep_name, pr.base.ref)
+    job.branch_sha = branch_sha
+    if (rebuild_required and (not merge or not rebuild_before_merge)
+        and build_store.pair_succeeded(rep_name, pr.head.sha, branch_sha)):
+        log("ALREADY BUILT: %s/%d" % (rep_name, pr.number))
+        rebuild_required = False
     if not rebuild_required and not merge:
-        log("Invalid call: rebuild_required=False, merge=False")
+        log("Nothing to do: rebuild_required=False, merge=False")
         return
+    started = time.time()
+    outcome = buildstore.ERROR
+    try:
+        merge_and_build(pr, rebuild_required, merge, ticket, send_notification, branch_sha)
+        outcome = buildstore.SUCCEEDED
+    except (BuildError, MergeError, VerificationError) as ex:
+        outcome = failure_outcome(ex)
+        raise
+    finally:
+        build_store.record(rep_name, pr.number, pr.head.sha, branch_sha, outcome,
+                           started, time.time() - started, current_log_path())
+        metrics.inc("builds_total", outcome=outcome)
+
+def failure_outcome(ex):
+    """The outcome recorded in the build store for the given failure."""
+    if isinstance(ex, MergeError): return "merge-failed"
+    if isinstance(ex, VerificationError): return "verification-failed"
+    return "build-failed"
+
+def record_batch_outcome(pr, branch_sha, outcome, started):
+    """Record the outcome of the given pull request, processed as part of a
+    batch, in the build store."""
+    build_store.record(pr.base.repo.name, pr.number, pr.head.sha, branch_sha, outcome,
+                       started, time.time() - started, current_log_path(), "batch")
+
+def merge_and_build(pr, rebuild_required, merge, ticket, send_notification, branch_sha):
+    """Merge the given pull request into a fresh build tree, and build it if
+    required. If the merge has been requested, push the merge to the main
+    repository, provided neither the branch (still at branch_sha) nor the pull
+    request changed in the meantime."""
+    rep_name = pr.base.repo.name
+    log("Processing pull request %s/%s/%d .." % (org_name, rep_name, pr.number))
+    workspace = workspace_pool.acquire(branch_whitelist[pr.base.ref])
+    try:
+        build_in_workspace(pr, rebuild_required, merge, ticket, send_notification,
+                           branch_sha, workspace)
+    finally:
+        workspace_pool.release(workspace)
+
+def build_in_workspace(pr, rebuild_required, merge, ticket, send_notification,
+                       branch_sha, workspace):
+    """Merge and build the given pull request in the given workspace."""
     rep_name = pr.base.repo.name
-    rep_path = "%s/%s" % (org_name, rep_name)
-    user = pr.user.login # user doing the pull request
-    owner = pr.head.repo.owner.login # owner of the pull request's repository
-    log("Processing pull request %s/%d .." % (rep_path, pr.number))
     component_name = rep_names[rep_name]
-    rep_dir = "%s/myrepos/%s" % (build_path, rep_name)
     branch = pr.base.ref
-    branch_sha = get_cached_branch_sha(rep_name, branch)
-    internal_branch = branch_whitelist[branch]
-    build_rep = "%s/%s/build.hg" % (build_rep_prefix, internal_branch)
-    path_cmds = [
-        (settings.builds_path, "sudo rm -rf %s %s" % (build_dir, log_file)),
-        (settings.builds_path, "hg clone %s %s" % (build_rep, build_dir)),
-        (build_path, "make manifest-latest"),
-        ]
-    for path, cmd in path_cmds: execute_and_report(path, cmd)
-#    for c in rep_names.itervalues(): execute_and_report(build_path, "make %s-myclone" % c)
-    execute_and_report(build_path, "make %s-myclone" % component_name)
-    merge_msg = "Merge pull request #%d from %s/%s" % (pr.number,owner,pr.head.ref)
-    path_cmds = [
-        (rep_dir, "git config user.name %s" % bot_name),
-        (rep_dir, "git config user.email %s" % settings.bot_email),
-        (rep_dir, "git checkout master"),
-        (rep_dir, "git remote add %s git://github.com/%s/%s.git" % (user, owner, rep_name)),
-        (rep_dir, "git fetch %s" % user),
-        (rep_dir, "git merge -m \"%s\" %s" % (merge_msg,pr.head.sha)),
-        ]
-    for path, cmd in path_cmds: execute_and_report(path, cmd)
+    build_path = workspace.path
+    rep_dir = workspace.rep_dir(rep_name)
+    with metrics.timer("build_phase_seconds", "setup"):
+        try:
+            workspace.prepare(component_name, rep_name)
+        except WorkspaceError as ex:
+            raise BuildError(ex.message)
+    with metrics.timer("build_phase_seconds", "merge"):
+        execute_and_report(rep_dir, "git checkout master")
+        merge_pull_request(pr, rep_dir)
     pr_ref = get_pr_ref(pr)
-    branch_ref = get_branch_ref(rep_name, branch)
+    branch_ref = get_branch_ref(rep_name, branch, branch_sha)
     msg = bot_msg_prefix(pr_ref, branch_ref)
-    if verify_whitespace_changes(rep_dir, pr):
-        msg += " Whitespace changes verified."
-    if rebuild_required:
-        execute_and_report(build_path, "make %s-build" % component_name)
-        if component_name != "api":
-            execute_and_report(build_path, "make api-build")
+    with metrics.timer("build_phase_seconds", "whitespace"):
+        if verify_whitespace_changes(rep_dir, pr):
+            msg += " Whitespace changes verified."
     msg += " Build succeeded."
+    if rebuild_required:
+        with metrics.timer("build_phase_seconds", "build"):
+            cached = build_component(build_path, component_name)
+        if cached: msg += " Served from cache: %s." % ", ".join(cached)
+    log("TIMING: %s" % metrics.summary())
     if merge:
-        fresh_branch_sha = get_fresh_branch_sha(rep_name, branch)
-        if fresh_branch_sha != branch_sha:
-            fresh_branch_ref = get_branch_ref(rep_name, branch, fresh_branch_sha)
-            raise MergeError("Branch %s updated since to %s." % (branch, fresh_branch_ref))
-        fresh_pr = org.get_repo(rep_name).get_pull(pr.number)
-        if fresh_pr.state != "open":
-            raise MergeError("Pull request %s no longer 'open'." % rep_path)
-        if fresh_pr.head.sha != pr.head.sha:
-            fresh_pr_ref = get_pr_ref(fresh_pr)
-            raise MergeError("Pull request %s modified since to %s." % (rep_path, fresh_pr_ref))
-        rep_url = "git@github-xen-git:%s.git" % rep_path
-        path_cmds = [
-            (rep_dir, "git remote add %s %s" % (org_name, rep_url)),
-            (rep_dir, "git push %s master:%s" % (org_name, branch)),
-            ]
-        if active:
-            for path, cmd in path_cmds: execute_and_report(path, cmd)
-        msg += " Pull request merged." 
-        '''
-        if settings.jira_url and ticket:
-            ticket_ref = "[{0}](http://jira/browse/{0})".format(ticket)
-            try:
-                closeTicket(pr, ticket)
-                msg += " Closed ticket %s." % ticket_ref
-            except Exception, e:
-                traceback.print_exc()
-                msg += " Failed to close ticket %s (reason: %s)." % (ticket_ref, e)
-        '''
-        print_msg(pr, msg)
-        if active:
-            pr.base.repo.get_issue(pr.number).create_comment(msg.replace('%','_'))
-            pr.base.repo.get_issue(pr.number).edit(state="closed")
-        log("Allowing for local/GitHub repos re-sync. Sleeping for %ds." % resync_sleep)
-        time.sleep(resync_sleep)
+        # pushes to the same branch are serialised, so that the checks
+        # below remain valid until the push
+        with exclusive_push(rep_name, branch):
+            push_merge(pr, rep_dir, branch_sha, msg, ticket)
     else:
         msg += " Can merge pull request."
         if (send_notification):
             assignee = ""
             if (branch == "tampa"):
                 assignee = settings.jira_assignee
-            if (branch == "boston-lcm" or branch == "tampa-lcm" or branch = "sanibel-lcm"):
+            if (branch == "boston-lcm" or branch == "tampa-lcm" or branch == "sanibel-lcm"):
                 assignee = settings.jira_lcm_assignee
             if (assignee != ""):
                 ca_ticket = create_jira_issue(pr, settings.jira_assignee)
                 msg += "\nJira ticket %s" % ca_ticket
+        msg += "\nTimings: %s." % metrics.summary()
+        print_msg(pr, msg)
+        if active:
+            pr.base.repo.get_issue(pr.number).create_comment(msg.replace('%','_'))
+            invalidate_cached_pull_request(rep_name, pr.number)
+
+def merge_pull_request(pr, rep_dir):
+    """Merge the head of the given pull request into the current branch of the
+    repository in rep_dir."""
+    rep_name = pr.base.repo.name
+    owner = pr.head.repo.owner.login # owner of the pull request's repository
+    try:
+        mirror_cache.fetch_pull_request(org_name, rep_name, pr)
+        mirror_cache.share_objects(rep_name, rep_dir)
+    except MirrorError as ex:
+        raise BuildError(ex.message)
+    merge_msg = "Merge pull request #%d from %s/%s" % (pr.number,owner,pr.head.ref)
+    path_cmds = [
+        (rep_dir, "git config user.name %s" % bot_name),
+        (rep_dir, "git config user.email %s" % settings.bot_email),
+        (rep_dir, "git merge -m \"%s\" %s" % (merge_msg,pr.head.sha)),
+        ]
+    for path, cmd in path_cmds: execute_and_report(path, cmd)
+
+def build_inputs(build_path):
+    """Identify everything a build in the given build tree depends on: the
+    revision of the manifest, and the trees of the component repositories."""
+    inputs = [execute_and_return(build_path, "hg id -i && hg diff | md5sum")]
+    myrepos = "%s/myrepos" % build_path
+    for rep_name in sorted(os.listdir(myrepos)):
+        tree = execute_and_return("%s/%s" % (myrepos, rep_name), "git rev-parse HEAD^{tree}")
+        inputs.append("%s %s" % (rep_name, tree.strip()))
+    return inputs
+
+def build_component(build_path, component_name):
+    """Build the given component, and the components depending on it. Steps
+    whose outputs were cached for the same inputs are not executed, but their
+    outputs are restored instead. Returns the steps served from cache."""
+    steps = ["%s-build" % component_name]
+    if component_name != "api": steps.append("api-build")
+    inputs = build_inputs(build_path)
+    # restore the outputs of as many steps as possible, starting from the last
+    cached = []
+    for i in range(len(steps), 0, -1):
+        if artifact_cache.restore(artifact_cache.key(steps[i - 1], inputs), build_path):
+            cached = steps[:i]
+            break
+    for step in steps[len(cached):]:
+        execute_and_report(build_path, "make %s" % step)
+        artifact_cache.store(artifact_cache.key(step, inputs), build_path, build_outputs)
+    if cached: log("FROM CACHE: %s" % ", ".join(cached))
+    return cached
+
+def push_merge(pr, rep_dir, branch_sha, msg, ticket):
+    """Push the merge of the given pull request in rep_dir, provided neither
+    the branch nor the pull request changed since the build started, and close
+    the pull request."""
+    rep_name = pr.base.repo.name
+    rep_path = "%s/%s" % (org_name, rep_name)
+    branch = pr.base.ref
+    fresh_branch_sha = get_fresh_branch_sha(rep_name, branch)
+    if fresh_branch_sha != branch_sha:
+        fresh_branch_ref = get_branch_ref(rep_name, branch, fresh_branch_sha)
+        raise MergeError("Branch %s updated since to %s." % (branch, fresh_branch_ref))
+    fresh_pr = org.get_repo(rep_name).get_pull(pr.number)
+    if fresh_pr.state != "open":
+        raise MergeError("Pull request %s no longer 'open'." % rep_path)
+    if fresh_pr.head.sha != pr.head.sha:
+        fresh_pr_ref = get_pr_ref(fresh_pr)
+        raise MergeError("Pull request %s modified since to %s." % (rep_path, fresh_pr_ref))
+    rep_url = "git@github-xen-git:%s.git" % rep_path
+    if active:
+        with metrics.timer("build_phase_seconds", "push"):
+            execute_and_report(rep_dir, "git remote add %s %s" % (org_name, rep_url))
+            if not holds_push_lease(rep_name, branch):
+                raise MergeError("Lost the lease on branch %s before pushing." % branch)
+            execute_and_report(rep_dir, "git push %s master:%s" % (org_name, branch))
+        invalidate_cached_branches(rep_name)
+    msg += " Pull request merged." 
+    msg += "\nTimings: %s." % metrics.summary()
+    '''
+    if settings.jira_url and ticket:
+        ticket_ref = "[{0}](http://jira/browse/{0})".format(ticket)
+        try:
+            closeTicket(pr, ticket)
+            msg += " Closed ticket %s." % ticket_ref
+        except Exception, e:
+            traceback.print_exc()
+            msg += " Failed to close ticket %s (reason: %s)." % (ticket_ref, e)
+    '''
+    print_msg(pr, msg)
+    if active:
+        pr.base.repo.get_issue(pr.number).create_comment(msg.replace('%','_'))
+        pr.base.repo.get_issue(pr.number).edit(state="closed")
+        invalidate_cached_pull_request(rep_name, pr.number)
+    start_resync(rep_name, branch)
+
+def get_merge_batches(items):
+    """Group the approved work items by repository and branch, in batches of at
+    most max_batch_size pull requests. Returns the batches of more than one
+    pull request, and the work items which are not merged as part of a batch
+    (approved pull requests which do not fit in their batch wait for the next
+    search)."""
+    if not merge_queue: return [], items
+    groups = {}
+    for item in items:
+        pr, _, merge, _, _ = item
+        # pull requests which failed unexpectedly before are processed alone
+        if merge and not quarantine.failures(item_key(item), pr.head.sha):
+            groups.setdefault((pr.base.repo.name, pr.base.ref), []).append(item)
+    groups = [group for group in groups.values() if len(group) > 1]
+    batched = set([id(item) for group in groups for item in group])
+    batches = [order_items(group[:max_batch_size]) for group in groups]
+    return batches, [item for item in items if id(item) not in batched]
+
+def run_batch_job(items):
+    """Process the given batch of approved pull requests in the current thread,
+    with its own log."""
+    pr = items[0][0]
+    job.log_path = "%s/build-%s-%s-%s.log" % (settings.builds_path, bot_name,
+                                              pr.base.repo.name, pr.base.ref)
+    open(job.log_path, "w").close()
+    executor.start_job()
+    metrics.start_job()
+    job.quarantined = set() # keys of the pull requests put in quarantine
+    try:
+        process_batch(items, get_cached_branch_sha(pr.base.repo.name, pr.base.ref))
+    except Exception as ex:
+        log("Unexpected error occurred while processing a batch of %s/%s."
+            % (pr.base.repo.name, pr.base.ref))
+        handle_unexpected_error([item[0] for item in items], ex)
+        return
+    finally:
+        for item in items: work_queue.finished(item_key(item))
+        release_items(items)
+    for item in items:
+        if item_key(item) not in job.quarantined:
+            quarantine.cleared(item_key(item), item[0].head.sha)
+
+def quarantine_batch(items, ex):
+    """Put the pull requests of the given work items, processed as part of a
+    batch, in quarantine after an unexpected error."""
+    job.quarantined.update([item_key(item) for item in items])
+    handle_unexpected_error([item[0] for item in items], ex)
+
+def process_batch(items, branch_sha):
+    """Merge all pull requests of the given batch together into the branch (at
+    branch_sha), build the result once, and push it if the build succeeds. If
+    the build fails, bisect the batch to find the culprit(s). Returns the SHA
+    the branch is at afterwards. Each build of the bisection gets its own
+    deadline, and an unexpected error only puts the pull requests of the build
+    it happened in into quarantine."""
+    pr = items[0][0]
+    rep_name = pr.base.repo.name
+    branch = pr.base.ref
+    job.branch_sha = branch_sha
+    job.deadline = time.time() + build_timeout
+    metrics.start_job()
+    if len(items) == 1:
+        # a batch of one is just a normal merge
+        pr, rebuild, merge, ticket, send_notification = items[0]
+        try:
+            process_pull_request(pr, rebuild, merge, ticket, send_notification,
+                                 branch_sha)
+            return get_fresh_branch_sha(rep_name, branch)
+        except BuildError as ex:
+            report_error(pr, ex.message, True)
+        except (MergeError, VerificationError) as ex:
+            report_error(pr, ex.message, False)
+        except Exception as ex:
+            # global faults stop the whole batch; process_pull_request
+            # recorded the error
+            if is_global_fault(ex): raise
+            log("Unexpected error occurred while processing %s/%d." % (rep_name, pr.number))
+            quarantine_batch(items, ex)
+        return branch_sha
+    log("Processing batch of %s/%s: %s .." % (rep_name, branch,
+        ", ".join(["#%d" % item[0].number for item in items])))
+    started = time.time()
+    try:
+        branch_sha, failed = build_batch(items, branch_sha, started)
+    except Exception as ex:
+        if is_global_fault(ex): raise
+        log("Unexpected error occurred while processing a batch of %s/%s." % (rep_name, branch))
+        for item in items:
+            record_batch_outcome(item[0], branch_sha, buildstore.ERROR, started)
+        quarantine_batch(items, ex)
+        return branch_sha
+    if not failed: return branch_sha
+    half = len(failed) / 2
+    branch_sha = process_batch(failed[:half], branch_sha)
+    return process_batch(failed[half:], branch_sha)
+
+def build_batch(items, branch_sha, started):
+    """Merge the pull requests of the given batch (of more than one) together
+    into the branch at branch_sha, build the result, and push it if the build
+    succeeds. Returns the SHA the branch is at afterwards, and the merged work
+    items if the build failed with more than one of them (None otherwise)."""
+    pr = items[0][0]
+    rep_name = pr.base.repo.name
+    branch = pr.base.ref
+    workspace = workspace_pool.acquire(branch_whitelist[branch])
+    try:
+        try:
+            merged, rep_dir = merge_batch(items, workspace, branch_sha, started)
+        except BuildError as ex:
+            record_batch_outcome(pr, branch_sha, "build-failed", started)
+            report_error(pr, ex.message, True)
+            return branch_sha, None
+        if not merged: return branch_sha, None
+        try:
+            with metrics.timer("build_phase_seconds", "build"):
+                cached = build_component(workspace.path, rep_names[rep_name])
+        except BuildError as ex:
+            if len(merged) > 1:
+                log("BATCH FAILED: bisecting %s/%s" % (rep_name, branch))
+                # the bisection records the outcome of each pull request
+                for item in merged:
+                    record_batch_outcome(item[0], branch_sha, buildstore.BATCH_FAILED, started)
+                return branch_sha, merged
+            culprit = merged[0][0]
+            record_batch_outcome(culprit, branch_sha, "build-failed", started)
+            report_error(culprit, ex.message, True)
+            return branch_sha, None
+        with exclusive_push(rep_name, branch):
+            return push_batch(merged, rep_dir, branch_sha, started, cached), None
+    finally:
+        workspace_pool.release(workspace)
+
+def merge_batch(items, workspace, branch_sha, started):
+    """Merge the pull requests of the batch one after the other in the given
+    workspace. Pull requests which fail to merge or verify are recorded (as
+    merged into branch_sha), reported and left out. Returns the merged work
+    items, and the repository's directory."""
+    pr = items[0][0]
+    rep_name = pr.base.repo.name
+    rep_dir = workspace.rep_dir(rep_name)
+    with metrics.timer("build_phase_seconds", "setup"):
+        try:
+            workspace.prepare(rep_names[rep_name], rep_name)
+        except WorkspaceError as ex:
+            raise BuildError(ex.message)
+    execute_and_report(rep_dir, "git checkout master")
+    merged = []
+    for item in items:
+        pr = item[0]
+        prev = execute_and_return(rep_dir, "git rev-parse HEAD").strip()
+        try:
+            with metrics.timer("build_phase_seconds", "merge"):
+                merge_pull_request(pr, rep_dir)
+            with metrics.timer("build_phase_seconds", "whitespace"):
+                verify_whitespace_changes(rep_dir, pr)
+            merged.append(item)
+        except (BuildError, MergeError, VerificationError) as ex:
+            execute(rep_dir, "git merge --abort")
+            execute_and_report(rep_dir, "git reset --hard %s" % prev)
+            record_batch_outcome(pr, branch_sha, failure_outcome(ex), started)
+            report_error(pr, ex.message, isinstance(ex, BuildError))
+    return merged, rep_dir
+
+def push_batch(items, rep_dir, branch_sha, started, cached):
+    """Push the merge of all pull requests of the batch at once, provided
+    neither the branch nor any of the pull requests changed since the build
+    started, and close the pull requests. Returns the new SHA of the branch."""
+    pr = items[0][0]
+    rep_name = pr.base.repo.name
+    rep_path = "%s/%s" % (org_name, rep_name)
+    branch = pr.base.ref
+    fresh_branch_sha = get_fresh_branch_sha(rep_name, branch)
+    if fresh_branch_sha != branch_sha:
+        # all pull requests are still approved, and will be retried
+        log("BATCH ABANDONED: branch %s/%s updated to %s" % (rep_name, branch, fresh_branch_sha))
+        return fresh_branch_sha
+    for pr, _, _, _, _ in items:
+        fresh_pr = org.get_repo(rep_name).get_pull(pr.number)
+        if fresh_pr.state != "open" or fresh_pr.head.sha != pr.head.sha:
+            log("BATCH ABANDONED: %s/%d changed" % (rep_name, pr.number))
+            return branch_sha
+    new_branch_sha = execute_and_return(rep_dir, "git rev-parse HEAD").strip()
+    rep_url = "git@github-xen-git:%s.git" % rep_path
+    if active:
+        with metrics.timer("build_phase_seconds", "push"):
+            execute_and_report(rep_dir, "git remote add %s %s" % (org_name, rep_url))
+            if not holds_push_lease(rep_name, branch):
+                # all pull requests are still approved, and will be retried
+                log("BATCH ABANDONED: lost the lease on %s/%s" % (rep_name, branch))
+                return branch_sha
+            execute_and_report(rep_dir, "git push %s master:%s" % (org_name, branch))
+        invalidate_cached_branches(rep_name)
+    numbers = ["#%d" % item[0].number for item in items]
+    branch_ref = get_branch_ref(rep_name, branch, branch_sha)
+    for pr, _, _, _, _ in items:
+        record_batch_outcome(pr, branch_sha, buildstore.SUCCEEDED, started)
+        msg = bot_msg_prefix(get_pr_ref(pr), branch_ref)
+        msg += " Build succeeded (together with %s)." % ", ".join(numbers)
+        if cached: msg += " Served from cache: %s." % ", ".join(cached)
+        msg += " Pull request merged."
+        msg += "\nTimings (batch): %s." % metrics.summary()
         print_msg(pr, msg)
-        if active: pr.base.repo.get_issue(pr.number).create_comment(msg.replace('%','_'))
+        if active:
+            pr.base.repo.get_issue(pr.number).create_comment(msg.replace('%','_'))
+            pr.base.repo.get_issue(pr.number).edit(state="closed")
+            invalidate_cached_pull_request(rep_name, pr.number)
+    start_resync(rep_name, branch)
+    return new_branch_sha
 
 def get_fresh_branch_sha(rep_name, branch):
     """Obtain SHA of the last commit of the specified branch of the specified
@@ -435,6 +1001,76 @@ def get_cached_branch_sha(rep_name, branch):
         branch_sha_cache[(rep_path, branch)] = branch_sha
     return branch_sha
 
+def get_branch_lock(rep_name, branch):
+    """Obtain the lock serialising pushes to the given branch."""
+    with branch_locks_lock:
+        return branch_locks.setdefault((rep_name, branch), threading.Lock())
+
+def start_resync(rep_name, branch):
+    """Let the local and GitHub repositories re-sync after a push to the given
+    branch: no merge into it is started for resync_sleep."""
+    log("Allowing for local/GitHub repos re-sync of %s/%s for %ds."
+        % (rep_name, branch, resync_sleep))
+    with branch_locks_lock:
+        resync_until[(rep_name, branch)] = time.time() + resync_sleep
+
+def resync_time_left(rep_name, branch):
+    """The seconds left until the given branch re-synced after its last push."""
+    with branch_locks_lock:
+        return max(resync_until.get((rep_name, branch), 0) - time.time(), 0)
+
+@contextmanager
+def exclusive_push(rep_name, branch):
+    """Serialise pushes to the given branch, between the threads of this
+    instance and, with leases, between instances. Pushes right after another
+    one (e.g. while bisecting a batch) first wait for the branch to re-sync."""
+    left = resync_time_left(rep_name, branch)
+    if left:
+        log("Waiting %ds for %s/%s to re-sync." % (left, rep_name, branch))
+        time.sleep(left)
+    with get_branch_lock(rep_name, branch):
+        if not leases:
+            yield
+            return
+        with leases.exclusive(push_lease_name(rep_name, branch), short_sleep):
+            yield
+
+def push_lease_name(rep_name, branch):
+    return "push:%s/%s" % (rep_name, branch)
+
+def holds_push_lease(rep_name, branch):
+    """Whether this instance still holds the lease on pushing to the given
+    branch (always true without leases), which could have expired meanwhile."""
+    return not leases or leases.holds(push_lease_name(rep_name, branch))
+
+def claim_items(items):
+    """Claim the leases on the pull requests of the given work items, for
+    this instance. Returns whether all of them were claimed (if not, none is
+    held)."""
+    if not leases: return True
+    claimed = []
+    for item in items:
+        if not leases.claim("pr:%s/%d" % item_key(item)):
+            release_items(claimed)
+            return False
+        claimed.append(item)
+    return True
+
+def release_items(items):
+    if not leases: return
+    for item in items: leases.release("pr:%s/%d" % item_key(item))
+
+def invalidate_cached_pull_request(rep_name, number):
+    """Drop cached API responses about the given pull request, and the lists of
+    pull requests of its repository."""
+    rep_url = "/repos/%s/%s" % (org_name, rep_name)
+    api_cache.invalidate("%s/issues/%d" % (rep_url, number))
+    api_cache.invalidate("%s/pulls" % rep_url)
+
+def invalidate_cached_branches(rep_name):
+    """Drop cached API responses about the branches of the given repository."""
+    api_cache.invalidate("/repos/%s/%s/branches" % (org_name, rep_name))
+
 def get_branch_ref(rep_name, branch, branch_sha=None):
     if not branch_sha: branch_sha = get_cached_branch_sha(rep_name, branch)
     return "%s/%s@%s" % (org_name, rep_name, branch_sha)
@@ -452,37 +1088,203 @@ def clear_state():
 def log(msg):
     print "[%s] %s" % (time.ctime(), msg)
 
+# warm build trees, one per concurrent build of an internal branch
+workspace_pool = WorkspacePool(settings.builds_path, "build-%s" % bot_name,
+                               build_rep_prefix, execute, log)
+
+# roles of the members of the organisation's teams
+membership = Membership(org, privileges_ttl, pr_authors_team, branch_validators, log)
+
+# local bare mirrors of the repositories, shared by all build trees
+mirror_cache = MirrorCache("%s/mirrors-%s" % (settings.builds_path, bot_name),
+                           "git://github.com", execute, log)
+
+# hashes of normalised OCaml sources, by blob SHA
+whitespace_verifier = WhitespaceVerifier("%s/whitespace-%s.db" % (settings.builds_path, bot_name),
+                                         whitespace_workers, log)
+
+def job_log_path(pr):
+    return "%s/build-%s-%s-%d.log" % (settings.builds_path, bot_name,
+                                      pr.base.repo.name, pr.number)
+
+def job_keys(items):
+    """Keys held by a job processing the given work items: the pull requests,
+    and the branches merged into, so that only one job merges into a branch at
+    any time."""
+    keys = [(pr.base.repo.name, pr.number) for pr, _, _, _, _ in items]
+    keys.extend(set([("merge", pr.base.repo.name, pr.base.ref)
+                     for pr, _, merge, _, _ in items if merge]))
+    return keys
+
+def run_job(pr, rebuild, merge, ticket, send_notification):
+    """Process the given pull request in the current thread, with its own log
+    and deadline, and report any problem on the pull request."""
+    job.log_path = job_log_path(pr)
+    job.deadline = time.time() + build_timeout
+    job.branch_sha = None
+    open(job.log_path, "w").close()
+    executor.start_job()
+    metrics.start_job()
+    try:
+        process_pull_request(pr, rebuild, merge, ticket, send_notification)
+    except BuildError as ex:
+        report_error(pr, ex.message, True)
+    except MergeError as ex:
+        report_error(pr, ex.message, False)
+    except VerificationError as ex:
+        report_error(pr, ex.message, False)
+    except Exception as ex:
+        log("Unexpected error occurred while processing %s/%d."
+            % (pr.base.repo.name, pr.number))
+        handle_unexpected_error([pr], ex)
+        return
+    finally:
+        work_queue.finished((pr.base.repo.name, pr.number))
+        release_items([(pr, rebuild, merge, ticket, send_notification)])
+    quarantine.cleared((pr.base.repo.name, pr.number), pr.head.sha)
+
+def is_global_fault(ex):
+    """Whether the given exception is due to e.g. the loss of the network or of
+    GitHub's authorisation, rather than to a specific pull request."""
+    if isinstance(ex, (Watchdog, IOError, httplib.HTTPException)): return True
+    return isinstance(ex, GithubException) and ex.status in [401, 403]
+
+def handle_unexpected_error(prs, ex):
+    """Pause everything for a while after a global fault, or put the given
+    pull requests in quarantine otherwise."""
+    global paused_until
+    traceback.print_exc()
+    if is_global_fault(ex):
+        log("Global fault. Pausing for %ds." % long_sleep)
+        paused_until = time.time() + long_sleep
+        return
+    for pr in prs: quarantine_failure(pr, ex)
+
+def quarantine_failure(pr, ex):
+    """Put the given pull request in quarantine after an unexpected error, and
+    report on it once it is left alone until its head changes."""
+    key = (pr.base.repo.name, pr.number)
+    failures, retry_at = quarantine.failed(key, pr.head.sha, str(ex))
+    metrics.inc("quarantined_total")
+    if retry_at:
+        log("QUARANTINED: %s/%d after %d failures, until %s"
+            % (key + (failures, time.ctime(retry_at))))
+        return
+    log("QUARANTINED: %s/%d after %d failures, until its head changes" % (key + (failures,)))
+    report_error(pr, "Giving up after %d unexpected errors (last: %s). Push to the pull"
+                 " request to try again." % (failures, ex), False)
+
+def submit_job(scheduler, items, func, args, since):
+    """Start func(*args) processing the given work items (see BuildScheduler),
+    provided no other instance claimed them. Returns whether the job was
+    started."""
+    keys = job_keys(items)
+    if scheduler.free_slots() <= 0 or [key for key in keys if scheduler.is_running(key)]:
+        return False
+    # merges wait for their branch to re-sync without taking a build slot
+    if [key for key in keys if key[0] == "merge" and resync_time_left(*key[1:])]:
+        return False
+    if not claim_items(items):
+        log("CLAIMED BY ANOTHER INSTANCE: %s" % keys)
+        return False
+    if scheduler.submit(keys, func, args, since): return True
+    release_items(items)
+    return False
+
+def log_queue_waits(items):
+    """Log how long the pull requests of the given started work items waited
+    in the queue (since approval, for merges)."""
+    for item in items:
+        key = item_key(item)
+        log("QUEUE WAIT: %s/%d waited %ds" % (key + (work_queue.started(key),)))
+
 if __name__ == "__main__":
-    """Continually obtain pull requests, and process them. If there are no pull
-    requests to process, wait for a while."""
-    run = 0
+    """Continually obtain pull requests, and start processing them in the
+    background, as long as there are free build slots. Wait for a while between
+    two searches."""
+    scheduler = BuildScheduler(build_workers)
+    base_sleep = short_sleep
+    if webhook_port:
+        WebhookServer(webhook_port, webhook_secret, handle_event, log).start()
+        base_sleep = reconcile_sleep
+    if metrics_port: MetricsServer(metrics_port, metrics).start()
+    if leases: leases.start_heartbeat(log)
+    last_full_search = 0
     while True:
         try:
+            if paused_until > time.time():
+                log("Paused. Sleeping for %ds." % (paused_until - time.time()))
+                time.sleep(max(paused_until - time.time(), 0))
+            # deliveries wake the loop up before the end of its sleep, so
+            # full searches are also forced once reconcile_sleep has elapsed
+            if not wakeup.is_set() or time.time() - last_full_search >= reconcile_sleep:
+                request_full_search()
+                last_full_search = time.time()
+            wakeup.clear()
             clear_state()
+            metrics.start_job()
+            scan_started = time.time()
             with Watchdog(fetch_timeout):
-                if run % 10 == 0:
-                    run = 0
-                    refresh_privileges()
-                pr, rebuild, merge, ticket, send_notification = get_next_pull_request()
-            if pr:
-                with Watchdog(build_timeout):
-                    process_pull_request(pr, rebuild, merge, ticket, send_notification)
-            else:
+                with metrics.timer("scan_phase_seconds", "refresh_privileges"):
+                    membership.refresh()
+                with metrics.timer("scan_phase_seconds", "search"):
+                    items = prioritise(get_pull_requests())
+            if not items:
                 log("No appropriate pull requests found.")
-            log("Sleeping for %ds." % short_sleep)
-            time.sleep(short_sleep)
-            run += 1
-        except BuildError as ex:
-            report_error(pr, ex.message, True)
-        except MergeError as ex:
-            report_error(pr, ex.message, False)
-        except VerificationError as ex:
-            report_error(pr, ex.message, False)
+            batches, items = get_merge_batches(items)
+            for batch in batches:
+                keys = job_keys(batch)
+                if submit_job(scheduler, batch, run_batch_job, (batch,), scan_started):
+                    log("Started processing batch %s." % keys)
+                    log_queue_waits(batch)
+            waiting = 0
+            for item in items:
+                keys = job_keys([item])
+                if submit_job(scheduler, [item], run_job, item, scan_started):
+                    log("Started processing %s/%d." % keys[0])
+                    log_queue_waits([item])
+                elif not scheduler.is_running(keys[0]):
+                    waiting += 1
+            merge_waits = work_queue.wait_times("merge", time.time() - 24 * 3600)
+            merged_waits = [f for _, f in merge_waits if f is not None]
+            if merged_waits:
+                log("Merges finished in the last day: %ds after approval on average,"
+                    " %ds at most."
+                    % (sum(merged_waits) / len(merged_waits), max(merged_waits)))
+            hits, misses = api_cache.reset_counters()
+            log("API cache: %d hits, %d misses." % (hits, misses))
+            spent, calls = rate_limiter.end_cycle()
+            log("API requests: %d spent, %s left." % (spent, rate_limiter.remaining))
+            for endpoint in sorted(calls):
+                log("    %5d %s" % (calls[endpoint], endpoint))
+                metrics.inc("api_requests_total", calls[endpoint], endpoint=endpoint)
+            metrics.inc("api_cache_hits_total", hits)
+            metrics.inc("api_cache_misses_total", misses)
+            metrics.inc("api_requests_spent_total", spent)
+            if rate_limiter.remaining is not None:
+                metrics.set("api_rate_limit_remaining", rate_limiter.remaining)
+            metrics.set("queue_depth", work_queue.depth())
+            metrics.set("quarantined_pull_requests", quarantine.count())
+            metrics.set("waiting_pull_requests", waiting)
+            metrics.set("running_jobs", build_workers - scheduler.free_slots())
+            metrics.observe("cycle_seconds", time.time() - scan_started)
+            metrics.write_json(metrics_path)
+            sleep = rate_limiter.next_sleep(base_sleep, min_sleep, waiting)
+            log("Sleeping for up to %ds." % sleep)
+            wakeup.wait(sleep)
         except Watchdog:
             traceback.print_exc()
             log("Operation timed out. Sleeping for %ds." % long_sleep)
             time.sleep(long_sleep)
-        except:
+        except Exception as ex:
             traceback.print_exc()
-            log("Unexpected error occurred. Sleeping for %ds." % long_sleep)
-            time.sleep(long_sleep)
+            if rate_limiter.exhausted():
+                sleep = rate_limiter.time_to_reset()
+                log("GitHub rate limit exceeded. Sleeping for %ds." % sleep)
+                time.sleep(sleep)
+                continue
+            # errors due to specific pull requests are dealt with by quarantine,
+            # so only global faults need a long pause
+            sleep = long_sleep if is_global_fault(ex) else short_sleep
+            log("Unexpected error occurred. Sleeping for %ds." % sleep)
+            time.sleep(sleep)
@@ -0,0 +1,73 @@
+"""Who may do what, from the teams of the GitHub organisation.
+
+Members of teams with push or admin permission are administrators: they can
+approve pull requests, and ask the bot to check pull requests of anyone. The
+members of the pull request authors team, and the administrators, are authors:
+their pull requests are considered. The members of each team are fetched again
+once they are older than a TTL, or once told that they changed (e.g. by a
+webhook), so that a refresh usually only lists the teams."""
+
+import time, threading
+
+admin_permissions = ["admin", "push"]
+
+class Membership(object):
+    def __init__(self, org, ttl, authors_team, branch_validators, log):
+        """branch_validators: branch -> users who approve merges into it, instead
+        of the administrators."""
+        self.org = org
+        self.ttl = ttl
+        self.authors_team = authors_team
+        self.branch_validators = dict([(branch, frozenset(users))
+                                       for branch, users in branch_validators.items()])
+        self.log = log
+        self.lock = threading.Lock()
+        self.members = {} # team id -> (logins, time they were fetched)
+        # invalidations of each team (None: all teams), so that a refresh does
+        # not keep members which were invalidated while it was fetching them
+        self.invalidations = {}
+        self.admins = frozenset()
+        self.authors = frozenset()
+
+    def refresh(self):
+        """List the teams, fetch the members of the relevant teams which were
+        not fetched recently, and update the roles."""
+        now = time.time()
+        teams = [t for t in self.org.get_teams()
+                 if t.permission in admin_permissions or t.name == self.authors_team]
+        with self.lock:
+            members = dict([(t.id, self.members[t.id]) for t in teams if t.id in self.members])
+            invalidations = dict(self.invalidations)
+        for t in teams:
+            if t.id in members and now - members[t.id][1] < self.ttl: continue
+            self.log("Refreshing members of team %s.." % t.name)
+            members[t.id] = (frozenset([m.login for m in t.get_members()]), now)
+        admins = set()
+        authors = set()
+        for t in teams:
+            if t.permission in admin_permissions: admins.update(members[t.id][0])
+            if t.name == self.authors_team: authors.update(members[t.id][0])
+        with self.lock:
+            stale = self.invalidations.get(None) != invalidations.get(None)
+            self.members = dict([(team_id, m) for team_id, m in members.items() if not stale
+                                 and self.invalidations.get(team_id) == invalidations.get(team_id)])
+            self.admins = frozenset(admins)
+            self.authors = frozenset(authors | admins)
+
+    def invalidate(self, team_id=None):
+        """Fetch the members of the given team (or of all teams) at the next
+        refresh."""
+        with self.lock:
+            self.invalidations[team_id] = self.invalidations.get(team_id, 0) + 1
+            if team_id is None: self.members = {}
+            else: self.members.pop(team_id, None)
+
+    def is_admin(self, login):
+        return login in self.admins
+
+    def is_author(self, login):
+        return login in self.authors
+
+    def validators(self, branch):
+        """The users who approve merges into the given branch."""
+        return self.branch_validators.get(branch, self.admins)
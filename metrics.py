@@ -0,0 +1,139 @@
+"""Counters, gauges and timers of the bot's activity.
+
+Metrics are identified by a name and labels, and can be exported in the text
+format of Prometheus (served over HTTP), or as a JSON file. Timers also keep,
+per thread, the phases timed since the start of the current job, so that they
+can be summarised on the pull request."""
+
+import json, os, time, threading
+import BaseHTTPServer, SocketServer
+from contextlib import contextmanager
+
+class Metrics(object):
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.counters = {} # (name, labels) -> value
+        self.gauges = {} # (name, labels) -> value
+        self.timers = {} # (name, labels) -> (count, total seconds, max seconds)
+        self.local = threading.local()
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            count, total, longest = self.timers.get(key, (0, 0, 0))
+            self.timers[key] = (count + 1, total + seconds, max(longest, seconds))
+
+    @contextmanager
+    def timer(self, name, phase):
+        """Time the body of a with statement, as the given phase."""
+        started = time.time()
+        try:
+            yield
+        finally:
+            seconds = time.time() - started
+            self.observe(name, seconds, phase=phase)
+            self.phases().append((phase, seconds))
+
+    def start_job(self):
+        """Forget the phases timed before by the current thread."""
+        self.local.phases = []
+
+    def phases(self):
+        """The (phase, seconds) timed by the current thread since start_job."""
+        if not hasattr(self.local, "phases"): self.start_job()
+        return self.local.phases
+
+    def summary(self):
+        """The time spent in each phase by the current thread, in the order the
+        phases were first timed, e.g. 'setup 12s, build 5s'."""
+        phases = []
+        totals = {}
+        for phase, seconds in self.phases():
+            if phase not in totals: phases.append(phase)
+            totals[phase] = totals.get(phase, 0) + seconds
+        return ", ".join(["%s %ds" % (phase, totals[phase]) for phase in phases])
+
+    def prometheus(self):
+        """The metrics in the text format of Prometheus."""
+        with self.lock:
+            counters = dict(self.counters)
+            gauges = dict(self.gauges)
+            timers = dict(self.timers)
+        lines = []
+        def add(kind, values, suffixes):
+            for name in sorted(set([name for name, _ in values])):
+                lines.append("# TYPE %s%s %s" % (self.prefix, name, kind))
+                for (n, labels), value in sorted(values.items()):
+                    if n != name: continue
+                    if not isinstance(value, tuple): value = (value,)
+                    for suffix, v in zip(suffixes, value):
+                        lines.append("%s%s%s%s %s" % (self.prefix, name, suffix,
+                                                      format_labels(labels), v))
+        add("counter", counters, [""])
+        add("gauge", gauges, [""])
+        add("summary", timers, ["_count", "_sum"])
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        """The metrics as a JSON-serialisable dictionary."""
+        with self.lock:
+            entries = [("counters", self.counters), ("gauges", self.gauges),
+                       ("timers", self.timers)]
+            return dict([(kind, [{"name": name, "labels": dict(labels), "value": value}
+                                 for (name, labels), value in sorted(values.items())])
+                         for kind, values in entries])
+
+    def write_json(self, path):
+        """Write the metrics to the given file, atomically."""
+        tmp_path = "%s.tmp" % path
+        f = open(tmp_path, "w")
+        try:
+            json.dump(dict(self.snapshot(), time=time.time()), f, indent=1)
+        finally:
+            f.close()
+        os.rename(tmp_path, path)
+
+def format_labels(labels):
+    if not labels: return ""
+    return "{%s}" % ",".join(['%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+                              for k, v in labels])
+
+class MetricsServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Serves the given metrics on GET /metrics."""
+    daemon_threads = True
+
+    def __init__(self, port, metrics):
+        BaseHTTPServer.HTTPServer.__init__(self, ("", port), MetricsHandler)
+        self.metrics = metrics
+
+    def start(self):
+        """Serve requests in a background thread."""
+        thread = threading.Thread(target=self.serve_forever, name="metrics")
+        thread.daemon = True
+        thread.start()
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = self.server.metrics.prometheus()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
@@ -0,0 +1,81 @@
+"""Local bare mirrors of the component repositories.
+
+Build trees borrow objects from the mirrors (through git's alternates), so that
+objects are downloaded once, rather than once per contributor's fork and once
+per build. Heads of pull requests are fetched into the mirror by their exact
+SHA, and only if the mirror does not have them yet, so that a rebuild moves no
+objects at all, and an update of a pull request only moves its new commits."""
+
+import os, threading
+
+class MirrorError(Exception):
+    def __init__(self, message):
+        self.message = message
+    def __str__(self):
+        return self.message
+
+class MirrorCache(object):
+    def __init__(self, path, url_prefix, execute, log):
+        """execute(path, cmd) runs a command and returns its exit code."""
+        self.path = path
+        self.url_prefix = url_prefix
+        self.execute = execute
+        self.log = log
+        self.lock = threading.Lock()
+        self.locks = {} # repository name -> lock of its mirror
+
+    def run(self, path, cmd):
+        if self.execute(path, cmd) != 0:
+            raise MirrorError("Failed when executing:\n    %s" % cmd)
+
+    def url(self, owner, rep_name):
+        return "%s/%s/%s.git" % (self.url_prefix, owner, rep_name)
+
+    def mirror_dir(self, rep_name):
+        return "%s/%s.git" % (self.path, rep_name)
+
+    def mirror_lock(self, rep_name):
+        with self.lock:
+            return self.locks.setdefault(rep_name, threading.Lock())
+
+    def ensure_mirror(self, owner, rep_name):
+        mirror_dir = self.mirror_dir(rep_name)
+        if os.path.isdir(mirror_dir): return mirror_dir
+        if not os.path.isdir(self.path): os.makedirs(self.path)
+        self.log("Creating mirror of %s/%s.." % (owner, rep_name))
+        self.run(self.path, "git clone --bare %s %s.git" % (self.url(owner, rep_name), rep_name))
+        self.run(mirror_dir, "git config remote.origin.fetch '+refs/heads/*:refs/heads/*'")
+        # build trees depend on the mirror's objects, which must never be pruned
+        self.run(mirror_dir, "git config gc.auto 0")
+        return mirror_dir
+
+    def fetch_pull_request(self, owner, rep_name, pr):
+        """Make sure that the mirror of the given repository has the head commit
+        of the given pull request, and return the mirror's path."""
+        with self.mirror_lock(rep_name):
+            mirror_dir = self.ensure_mirror(owner, rep_name)
+            sha = pr.head.sha
+            if self.execute(mirror_dir, "git cat-file -e %s^{commit}" % sha) == 0:
+                return mirror_dir
+            self.run(mirror_dir, "git fetch origin")
+            head_url = self.url(pr.head.repo.owner.login, pr.head.repo.name)
+            ref = "refs/pull/%d/head" % pr.number
+            self.run(mirror_dir, "git fetch %s +%s:%s" % (head_url, sha, ref))
+            return mirror_dir
+
+    def share_objects(self, rep_name, rep_dir):
+        """Let the git repository in rep_dir use the objects of the mirror of
+        the given repository."""
+        objects = "%s/objects" % os.path.abspath(self.mirror_dir(rep_name))
+        alternates = "%s/.git/objects/info/alternates" % rep_dir
+        if os.path.exists(alternates):
+            f = open(alternates)
+            try:
+                if objects in [l.strip() for l in f.readlines()]: return
+            finally:
+                f.close()
+        f = open(alternates, "a")
+        try:
+            f.write("%s\n" % objects)
+        finally:
+            f.close()
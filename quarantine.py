@@ -0,0 +1,81 @@
+"""Quarantine of pull requests whose processing keeps failing unexpectedly.
+
+Failures are counted per pull request and head SHA. After a failure, the pull
+request is left alone for a delay doubling with every failure (up to a maximum),
+and after too many failures it is left alone until its head changes. Pushing to
+a pull request therefore always gets it out of quarantine."""
+
+import sqlite3, threading, time
+
+schema = """
+create table if not exists failures (
+    repo text not null,
+    pr integer not null,
+    head_sha text not null,
+    failures integer not null,
+    error text,
+    retry_at real, -- null once the retries are exhausted
+    primary key (repo, pr, head_sha)
+);
+"""
+
+class Quarantine(object):
+    def __init__(self, path, base_delay, max_delay, max_failures):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_failures = max_failures
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript(schema)
+
+    def get(self, key, head_sha):
+        with self.lock:
+            return self.db.execute("select * from failures where repo = ? and pr = ?"
+                                   " and head_sha = ?", key + (head_sha,)).fetchone()
+
+    def failed(self, key, head_sha, error):
+        """Record a failure of the given pull request. Returns the number of
+        failures, and when to retry (None if the retries are exhausted)."""
+        row = self.get(key, head_sha)
+        failures = (row["failures"] if row else 0) + 1
+        retry_at = None
+        if failures < self.max_failures:
+            retry_at = time.time() + min(self.base_delay * 2 ** (failures - 1), self.max_delay)
+        with self.lock:
+            self.db.execute("insert or replace into failures values (?, ?, ?, ?, ?, ?)",
+                            key + (head_sha, failures, error, retry_at))
+            self.db.commit()
+        return failures, retry_at
+
+    def cleared(self, key, head_sha):
+        """Forget the failures of the given pull request, which was processed."""
+        with self.lock:
+            self.db.execute("delete from failures where repo = ? and pr = ? and head_sha = ?",
+                            key + (head_sha,))
+            self.db.commit()
+
+    def failures(self, key, head_sha):
+        row = self.get(key, head_sha)
+        return row["failures"] if row else 0
+
+    def is_quarantined(self, key, head_sha):
+        row = self.get(key, head_sha)
+        return bool(row) and (row["retry_at"] is None or row["retry_at"] > time.time())
+
+    def retain(self, head_shas):
+        """Forget about all pull requests but the ones in the given key -> head
+        SHA dictionary, and about their previous heads."""
+        with self.lock:
+            rows = self.db.execute("select repo, pr, head_sha from failures").fetchall()
+            for repo, pr, head_sha in rows:
+                if head_shas.get((repo, pr)) != head_sha:
+                    self.db.execute("delete from failures where repo = ? and pr = ?"
+                                    " and head_sha = ?", (repo, pr, head_sha))
+            self.db.commit()
+
+    def count(self):
+        """The number of pull requests in quarantine."""
+        with self.lock:
+            return self.db.execute("select count(*) from failures where retry_at is null"
+                                   " or retry_at > ?", (time.time(),)).fetchone()[0]
@@ -0,0 +1,86 @@
+"""Tracking of GitHub's rate limit, and of the requests spent per cycle.
+
+The remaining quota and its reset time are taken from the X-RateLimit-* headers
+of every response. Requests answered with a 304 (revalidated from the cache) do
+not count against the quota, and are not counted as spent either."""
+
+import re, time, threading
+
+number_re = re.compile("/[0-9]+(?=/|$)")
+repo_re = re.compile("^/repos/[^/]+/[^/]+")
+
+def endpoint(method, url):
+    """The endpoint of the given request, e.g. GET /repos/:repo/issues/:n."""
+    path = url.split("?", 1)[0]
+    path = repo_re.sub("/repos/:repo", path)
+    return "%s %s" % (method, number_re.sub("/:n", path))
+
+class RateLimiter(object):
+    def __init__(self, cycle_budget, reserve):
+        self.cycle_budget = cycle_budget # requests a cycle may spend
+        self.reserve = reserve # requests left for builds (comments, pushes..)
+        self.lock = threading.Lock()
+        self.limit = None
+        self.remaining = None
+        self.reset = None # time when the quota is reset
+        self.spent = 0 # requests counted against the quota this cycle
+        self.calls = {} # endpoint -> requests this cycle
+        self.cycle_costs = [] # requests spent by recent cycles
+
+    def request(self, method, url):
+        with self.lock:
+            e = endpoint(method, url)
+            self.calls[e] = self.calls.get(e, 0) + 1
+
+    def response(self, status, headers):
+        headers = dict((k.lower(), v) for k, v in headers)
+        with self.lock:
+            if status != 304: self.spent += 1
+            try:
+                self.limit = int(headers["x-ratelimit-limit"])
+                self.remaining = int(headers["x-ratelimit-remaining"])
+                self.reset = float(headers["x-ratelimit-reset"])
+            except (KeyError, ValueError):
+                pass
+
+    def allowance(self):
+        """The number of requests which can still be spent in this cycle."""
+        with self.lock:
+            budget = self.cycle_budget - self.spent
+            if self.remaining is not None:
+                budget = min(budget, self.remaining - self.reserve)
+            return max(budget, 0)
+
+    def exhausted(self):
+        with self.lock:
+            return self.remaining == 0 and self.reset > time.time()
+
+    def time_to_reset(self):
+        with self.lock:
+            if self.reset is None: return 0
+            return max(self.reset - time.time(), 0)
+
+    def end_cycle(self):
+        """Returns the requests spent, and the requests made by endpoint, in
+        this cycle, and starts a new cycle."""
+        with self.lock:
+            spent, calls = self.spent, self.calls
+            self.cycle_costs = (self.cycle_costs + [spent])[-10:]
+            self.spent = 0
+            self.calls = {}
+        return spent, calls
+
+    def next_sleep(self, base, minimum, queue_length):
+        """How long to wait before the next cycle: shorter than base when work
+        is waiting and there is enough quota left, longer than base when the
+        quota would not last until it is reset at the current pace."""
+        with self.lock:
+            remaining, reset = self.remaining, self.reset
+            costs = self.cycle_costs
+        sleep = minimum if queue_length > 0 else base
+        if remaining is None or reset is None or not costs: return sleep
+        time_to_reset = max(reset - time.time(), 0)
+        if remaining <= self.reserve: return max(sleep, time_to_reset)
+        cost = max(float(sum(costs)) / len(costs), 1)
+        affordable_cycles = (remaining - self.reserve) / cost
+        return max(sleep, time_to_reset / affordable_cycles)
@@ -0,0 +1,50 @@
+"""Runs a bounded number of jobs (builds of pull requests) at once, each in its
+own thread."""
+
+import threading, time
+
+class BuildScheduler(object):
+    def __init__(self, workers):
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.threads = [] # running threads
+        self.running = {} # key -> thread of the job holding it
+        self.finished = {} # key -> time the last job holding it finished
+
+    def free_slots(self):
+        with self.lock:
+            return self.workers - len(self.threads)
+
+    def is_running(self, key):
+        with self.lock:
+            return key in self.running
+
+    def submit(self, keys, func, args, since=None):
+        """Start func(*args) in a new thread, holding the given keys (e.g. the
+        pull requests it processes), unless a running job holds any of them, a
+        job holding any of them finished after since (e.g. while the work was
+        being looked for), or all slots are taken. Returns whether the job was
+        started."""
+        with self.lock:
+            if len(self.threads) >= self.workers: return False
+            for key in keys:
+                if key in self.running: return False
+                if since is not None and self.finished.get(key, 0) > since:
+                    return False
+            thread = threading.Thread(target=self.run, args=(keys, func, args),
+                                      name="job-%s" % (keys[0],))
+            thread.daemon = True
+            self.threads.append(thread)
+            for key in keys: self.running[key] = thread
+        thread.start()
+        return True
+
+    def run(self, keys, func, args):
+        try:
+            func(*args)
+        finally:
+            with self.lock:
+                self.threads.remove(threading.current_thread())
+                for key in keys:
+                    del self.running[key]
+                    self.finished[key] = time.time()
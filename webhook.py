@@ -0,0 +1,59 @@
+"""A small HTTP server receiving GitHub webhook deliveries.
+
+Each POST is passed on as (event name, decoded JSON payload), where the event
+name is taken from the X-GitHub-Event header. If a secret is configured, the
+X-Hub-Signature header of each delivery is checked. Recorded payloads can be
+replayed locally with e.g.:
+
+    curl -H "X-GitHub-Event: issue_comment" --data @payload.json localhost:8080/
+"""
+
+import json, hmac, hashlib, threading
+import BaseHTTPServer, SocketServer
+
+class WebhookServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port, secret, handle_event, log):
+        """handle_event(event, payload) is called for each delivery."""
+        BaseHTTPServer.HTTPServer.__init__(self, ("", port), WebhookHandler)
+        self.secret = secret
+        self.handle_event = handle_event
+        self.log = log
+
+    def start(self):
+        """Serve requests in a background thread."""
+        thread = threading.Thread(target=self.serve_forever, name="webhook")
+        thread.daemon = True
+        thread.start()
+
+class WebhookHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.getheader("Content-Length", 0)))
+        if self.server.secret:
+            digest = hmac.new(self.server.secret, body, hashlib.sha1).hexdigest()
+            signature = self.headers.getheader("X-Hub-Signature") or ""
+            # compared in constant time, not to tell how much of it is right
+            if not hmac.compare_digest(signature, "sha1=%s" % digest):
+                self.send_response(403)
+                self.end_headers()
+                return
+        event = self.headers.getheader("X-GitHub-Event")
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            self.send_response(400)
+            self.end_headers()
+            return
+        try:
+            self.server.handle_event(event, payload)
+        except Exception, e:
+            self.server.log("Failed to handle %s event: %s" % (event, e))
+            self.send_response(500)
+            self.end_headers()
+            return
+        self.send_response(204)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        self.server.log("Webhook: %s" % (format % args))
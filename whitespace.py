@@ -0,0 +1,176 @@
+"""Verification that commits marked as whitespace (or indentation) changes do
+not change the OCaml code they touch.
+
+File versions are read straight from git's object database, without checking
+anything out, and normalised (pretty-printed without comments by camlp4) in
+parallel. The hash of a normalised file version is remembered by its blob SHA,
+also across restarts, so the same file version is never normalised twice. Like
+the commands of builds, git and camlp4 run in their own process group, killed
+with everything they started if the verification takes too long, and their
+errors go to the build's log."""
+
+import os, re, time, shelve, signal, hashlib, tempfile, shutil, subprocess, threading
+from multiprocessing.pool import ThreadPool
+
+whitespace_re = re.compile("\[?(indentation|whitespace)", re.I)
+src_file_re = re.compile(".+\.ml[i]?")
+
+class CommandTimedOut(Exception):
+    def __init__(self, cmd):
+        Exception.__init__(self, cmd)
+        self.cmd = cmd
+
+def run(args, cwd=None, input=None, deadline=None, log_path=None):
+    """Run the given command, feeding it the given input, and return its exit
+    code and standard output. Its standard error is appended to the given log,
+    if any. The command is killed with all its children at the given deadline,
+    if any, raising CommandTimedOut."""
+    stderr = open(log_path, "a") if log_path else None
+    try:
+        p = subprocess.Popen(args, cwd=cwd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                             stderr=stderr, preexec_fn=os.setsid, close_fds=True)
+    finally:
+        if stderr: stderr.close()
+    timed_out = []
+    def kill():
+        timed_out.append(True)
+        try:
+            os.killpg(p.pid, signal.SIGKILL)
+        except OSError:
+            pass
+    timer = None
+    if deadline is not None:
+        timer = threading.Timer(max(deadline - time.time(), 0), kill)
+        timer.daemon = True
+        timer.start()
+    try:
+        output = p.communicate(input)[0]
+    finally:
+        if timer: timer.cancel()
+    if timed_out: raise CommandTimedOut(" ".join(args))
+    return p.returncode, output
+
+class WhitespaceVerifier(object):
+    def __init__(self, cache_path, workers, log):
+        self.cache = shelve.open(cache_path)
+        self.lock = threading.Lock()
+        self.workers = workers
+        self.log = log
+        self.local = threading.local() # deadline and log of the verification
+
+    def git(self, rep_dir, args, input=None):
+        returncode, output = run(["git"] + args, rep_dir, input,
+                                 self.local.deadline, self.local.log_path)
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, "git %s" % " ".join(args))
+        return output
+
+    def whitespace_commits(self, rep_dir, base, head):
+        """Returns (previous commit, commit) pairs for all whitespace commits
+        between base and head, in order."""
+        out = self.git(rep_dir, ["log", "--reverse", "--pretty=oneline", "%s..%s" % (base, head)])
+        commits = []
+        prev = base
+        for line in out.split("\n"):
+            if line == "": continue
+            curr, comment = line.split(" ", 1)
+            if whitespace_re.match(comment): commits.append((prev, curr))
+            prev = curr
+        return commits
+
+    def blob_shas(self, rep_dir, revs_and_files):
+        """Returns the blob SHA of each of the given (revision, file) pairs, or
+        None where the file does not exist."""
+        input = "".join(["%s:%s\n" % (rev, f) for rev, f in revs_and_files])
+        out = self.git(rep_dir, ["cat-file", "--batch-check"], input)
+        shas = []
+        for line in out.split("\n")[:len(revs_and_files)]:
+            parts = line.split()
+            shas.append(parts[0] if len(parts) == 3 and parts[1] == "blob" else None)
+        return shas
+
+    def blobs(self, rep_dir, shas):
+        """Returns the contents of the given blobs, read in one go."""
+        out = self.git(rep_dir, ["cat-file", "--batch"], "".join(["%s\n" % s for s in shas]))
+        contents = {}
+        pos = 0
+        for sha in shas:
+            eol = out.index("\n", pos)
+            size = int(out[pos:eol].split()[2])
+            contents[sha] = out[eol + 1:eol + 1 + size]
+            pos = eol + 1 + size + 1
+        return contents
+
+    def normalise(self, content_ext_and_limits):
+        """Returns the hash of the normalised form of the given (file content,
+        file extension, deadline, log path) tuple."""
+        content, ext, deadline, log_path = content_ext_and_limits
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            src_file = os.path.join(tmp_dir, "src%s" % ext)
+            f = open(src_file, "w")
+            try:
+                f.write(content)
+            finally:
+                f.close()
+            _, output = run(["camlp4", "-parser", "o", "-printer", "o", "-no_comments",
+                             src_file], deadline=deadline, log_path=log_path)
+            return hashlib.md5(output).hexdigest()
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def normalised_hashes(self, rep_dir, blobs):
+        """Returns the normalised hash of each of the given (blob SHA, file
+        extension) pairs, normalising only the ones not seen before."""
+        keys = dict([(blob, "%s%s" % blob) for blob in blobs if blob[0]])
+        with self.lock:
+            hashes = dict([(blob, self.cache[key]) for blob, key in keys.items()
+                           if self.cache.has_key(key)])
+        todo = [blob for blob in keys if blob not in hashes]
+        if todo:
+            self.log("Normalising %d file versions (%d cached).." % (len(todo), len(hashes)))
+            contents = self.blobs(rep_dir, list(set([sha for sha, ext in todo])))
+            pool = ThreadPool(self.workers)
+            try:
+                results = pool.map(self.normalise, [(contents[sha], ext, self.local.deadline,
+                                                     self.local.log_path)
+                                                    for sha, ext in todo])
+            finally:
+                pool.close()
+                pool.join()
+            with self.lock:
+                for blob, h in zip(todo, results):
+                    hashes[blob] = h
+                    self.cache[keys[blob]] = h
+                self.cache.sync()
+        hashes[(None, "")] = None
+        return hashes
+
+    def verify(self, rep_dir, base, head, timeout=None, log_path=None):
+        """Checks all whitespace commits between base and head, within timeout
+        seconds (if set), the errors of the commands going to the given log.
+        Returns whether there were any, and the first (file, commit) whose
+        normalised contents changed, or None."""
+        self.local.deadline = time.time() + timeout if timeout is not None else None
+        self.local.log_path = log_path
+        commits = self.whitespace_commits(rep_dir, base, head)
+        checks = []
+        for prev, curr in commits:
+            out = self.git(rep_dir, ["diff-tree", "-r", "--no-commit-id", "--name-only", curr])
+            for src_file in [f for f in out.split("\n") if src_file_re.match(f)]:
+                checks.append((prev, curr, src_file))
+        if not checks: return bool(commits), None
+        revs_and_files = []
+        for prev, curr, src_file in checks:
+            revs_and_files.extend([(prev, src_file), (curr, src_file)])
+        shas = self.blob_shas(rep_dir, revs_and_files)
+        blobs = []
+        for i, (prev, curr, src_file) in enumerate(checks):
+            ext = os.path.splitext(src_file)[1]
+            blobs.append(((shas[2 * i], ext) if shas[2 * i] else (None, ""),
+                          (shas[2 * i + 1], ext) if shas[2 * i + 1] else (None, "")))
+        hashes = self.normalised_hashes(rep_dir, [b for pair in blobs for b in pair])
+        for (prev, curr, src_file), (prev_blob, curr_blob) in zip(checks, blobs):
+            if hashes[prev_blob] != hashes[curr_blob]:
+                return True, (src_file, curr)
+        return True, None
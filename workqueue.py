@@ -0,0 +1,145 @@
+"""Persistent priority queue of work items (pull requests to build or merge).
+
+The priority of an item is the base priority of its kind (merges before
+builds), weighted by its repository and branch, plus a bonus growing with the
+time the item has waited, so that no item waits forever. An item keeps its
+place as long as the head SHA of its pull request does not change, including
+while it is being processed, so that an item processed again (e.g. a merge
+retried after its branch moved) still counts its wait from its approval. The
+time each item waited before being started, and until it finished, is
+recorded."""
+
+import sqlite3, threading, time
+
+schema = """
+create table if not exists queue (
+    repo text not null,
+    pr integer not null,
+    branch text not null,
+    head_sha text not null,
+    kind text not null,
+    enqueued real not null, -- when the head SHA was first seen
+    approved real, -- when the merge was first requested
+    started real, -- when the item started being processed, null if waiting
+    primary key (repo, pr)
+);
+create table if not exists waits (
+    id integer primary key autoincrement,
+    repo text not null,
+    pr integer not null,
+    head_sha text not null,
+    kind text not null,
+    enqueued real not null,
+    approved real,
+    started real not null,
+    finished real
+);
+"""
+
+class WorkQueue(object):
+    def __init__(self, path, priorities, aging, repo_weights, branch_weights):
+        """priorities: kind -> base priority; aging: priority gained per minute
+        waited; repo_weights, branch_weights: name -> weight (default 1)."""
+        self.priorities = priorities
+        self.aging = aging
+        self.repo_weights = repo_weights
+        self.branch_weights = branch_weights
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript(schema)
+        columns = [r[1] for r in self.db.execute("pragma table_info(queue)")]
+        if "started" not in columns: # queues created before it was added
+            self.db.execute("alter table queue add column started real")
+            self.db.commit()
+
+    def sync(self, entries, keep=()):
+        """Make the queue hold exactly the given (repo, pr, branch, head_sha,
+        kind) entries, besides the entries with a key in keep (e.g. running).
+        Entries already queued with the same head SHA keep their place."""
+        now = time.time()
+        with self.lock:
+            rows = dict([((r["repo"], r["pr"]), r) for r in
+                         self.db.execute("select * from queue").fetchall()])
+            wanted = set(keep)
+            for repo, pr, branch, head_sha, kind in entries:
+                wanted.add((repo, pr))
+                row = rows.get((repo, pr))
+                enqueued, approved, started = now, None, None
+                if row and row["head_sha"] == head_sha:
+                    enqueued, approved, started = row["enqueued"], row["approved"], row["started"]
+                if kind == "merge" and approved is None: approved = now
+                if kind != "merge": approved = None
+                self.db.execute("insert or replace into queue (repo, pr, branch, head_sha,"
+                                " kind, enqueued, approved, started)"
+                                " values (?, ?, ?, ?, ?, ?, ?, ?)",
+                                (repo, pr, branch, head_sha, kind, enqueued, approved, started))
+            for key in rows:
+                if key not in wanted:
+                    self.db.execute("delete from queue where repo = ? and pr = ?", key)
+            self.db.commit()
+
+    def priority(self, row, now):
+        waited = now - (row["approved"] or row["enqueued"])
+        return (self.priorities.get(row["kind"], 0)
+                * self.repo_weights.get(row["repo"], 1)
+                * self.branch_weights.get(row["branch"], 1)
+                + self.aging * waited / 60)
+
+    def ordered(self):
+        """Returns the keys of the waiting entries, highest priority first, only
+        keeping the first entry for the same head SHA and branch."""
+        now = time.time()
+        with self.lock:
+            rows = self.db.execute("select * from queue where started is null").fetchall()
+        rows.sort(key=lambda r: (-self.priority(r, now), r["enqueued"]))
+        keys = []
+        seen = set()
+        for r in rows:
+            if (r["repo"], r["branch"], r["head_sha"]) in seen: continue
+            seen.add((r["repo"], r["branch"], r["head_sha"]))
+            keys.append((r["repo"], r["pr"]))
+        return keys
+
+    def started(self, key):
+        """Record that the entry with the given key was started, and return how
+        long it waited. The entry stays queued until it leaves the queue (see
+        sync), so that it keeps its place if it is processed again."""
+        now = time.time()
+        with self.lock:
+            row = self.db.execute("select * from queue where repo = ? and pr = ?",
+                                  key).fetchone()
+            if not row: return 0
+            self.db.execute("insert into waits (repo, pr, head_sha, kind, enqueued,"
+                            " approved, started) values (?, ?, ?, ?, ?, ?, ?)",
+                            (row["repo"], row["pr"], row["head_sha"], row["kind"],
+                             row["enqueued"], row["approved"], now))
+            self.db.execute("update queue set started = ? where repo = ? and pr = ?",
+                            (now,) + key)
+            self.db.commit()
+        return now - (row["approved"] or row["enqueued"])
+
+    def finished(self, key):
+        with self.lock:
+            self.db.execute("update waits set finished = ? where id = (select max(id)"
+                            " from waits where repo = ? and pr = ?)", (time.time(),) + key)
+            self.db.execute("update queue set started = null where repo = ? and pr = ?", key)
+            self.db.commit()
+
+    def wait_times(self, kind, since):
+        """Returns the waits of the entries of the given kind started since the
+        given time, as (waited until started, waited until finished) pairs, the
+        latter None if not finished yet."""
+        with self.lock:
+            rows = self.db.execute("select * from waits where kind = ? and started >= ?",
+                                   (kind, since)).fetchall()
+        waits = []
+        for r in rows:
+            start = r["approved"] or r["enqueued"]
+            waits.append((r["started"] - start, r["finished"] and r["finished"] - start))
+        return waits
+
+    def depth(self):
+        with self.lock:
+            return self.db.execute("select count(*) from queue"
+                                   " where started is null").fetchone()[0]
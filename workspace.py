@@ -0,0 +1,134 @@
+"""Build trees which are kept between builds.
+
+A workspace is a clone of build.hg for one internal branch, with the component
+repositories under myrepos/. Instead of being cloned from scratch for every
+pull request, it is reset to a pristine state and updated incrementally. It is
+only re-created when it is found corrupted; other failures (e.g. of the network
+while pulling) are reported as such. Each workspace is used by at most one
+build at a time."""
+
+import os, time, threading
+
+class WorkspaceError(Exception):
+    def __init__(self, message):
+        self.message = message
+    def __str__(self):
+        return self.message
+
+class Workspace(object):
+    def __init__(self, parent, name, build_rep, execute, log):
+        """execute(path, cmd) runs a command and returns its exit code."""
+        self.parent = parent
+        self.name = name
+        self.path = "%s/%s" % (parent, name)
+        # component repositories not used by the current build are moved
+        # here, so that they stay warm without affecting the build
+        self.parked = "%s.parked" % self.path
+        self.build_rep = build_rep
+        self.execute = execute
+        self.log = log
+
+    def run(self, path, cmd):
+        if self.execute(path, cmd) != 0:
+            raise WorkspaceError("Failed when executing:\n    %s" % cmd)
+
+    def rep_dir(self, rep_name):
+        return "%s/myrepos/%s" % (self.path, rep_name)
+
+    def prepare(self, component_name, rep_name):
+        """Bring the workspace up to date for building the given component, and
+        return the number of seconds it took."""
+        started = time.time()
+        if not os.path.isdir(self.path):
+            self.log("Creating workspace %s.." % self.name)
+            self.recreate(component_name, rep_name)
+            return time.time() - started
+        problem = self.integrity_problem()
+        if not problem:
+            try:
+                self.park_other_repositories(rep_name)
+            except OSError as ex:
+                problem = "could not park repositories: %s" % ex
+        if problem:
+            self.log("Workspace %s is corrupted (%s); re-creating it.." % (self.name, problem))
+            self.recreate(component_name, rep_name)
+        else:
+            self.refresh(component_name, rep_name)
+        return time.time() - started
+
+    def integrity_problem(self):
+        """Returns why the build tree is corrupted, or None."""
+        if not os.path.isdir("%s/.hg" % self.path):
+            return "%s is not a Mercurial repository" % self.path
+        if self.execute(self.path, "hg verify -q") != 0:
+            return "hg verify failed"
+
+    def recreate(self, component_name, rep_name):
+        self.run(self.parent, "sudo rm -rf %s %s" % (self.name, os.path.basename(self.parked)))
+        self.run(self.parent, "hg clone %s %s" % (self.build_rep, self.name))
+        self.run(self.path, "make manifest-latest")
+        self.run(self.path, "make %s-myclone" % component_name)
+
+    def refresh(self, component_name, rep_name):
+        self.run(self.path, "hg --config extensions.purge= purge --all -X myrepos")
+        self.run(self.path, "hg update -C")
+        self.run(self.path, "hg pull -u")
+        self.run(self.path, "make manifest-latest")
+        rep_dir = self.rep_dir(rep_name)
+        if os.path.isdir(rep_dir) and (
+                not os.path.isdir("%s/.git" % rep_dir)
+                or self.execute(rep_dir, "git rev-parse --verify -q HEAD") != 0):
+            self.log("Repository %s of workspace %s is corrupted; re-cloning it.."
+                     % (rep_name, self.name))
+            self.run(self.path, "sudo rm -rf myrepos/%s" % rep_name)
+        if not os.path.isdir(rep_dir):
+            self.run(self.path, "make %s-myclone" % component_name)
+            return
+        self.run(rep_dir, "git checkout -f master")
+        self.run(rep_dir, "git fetch origin")
+        self.run(rep_dir, "git reset --hard master@{upstream}")
+        self.run(rep_dir, "git clean -fdx")
+        self.run(rep_dir, "git remote | grep -v '^origin$' | xargs -r -n1 git remote rm")
+
+    def park_other_repositories(self, rep_name):
+        myrepos = "%s/myrepos" % self.path
+        if not os.path.isdir(self.parked): os.makedirs(self.parked)
+        if os.path.isdir(myrepos):
+            for name in os.listdir(myrepos):
+                if name != rep_name:
+                    os.rename("%s/%s" % (myrepos, name), "%s/%s" % (self.parked, name))
+        parked_rep = "%s/%s" % (self.parked, rep_name)
+        if os.path.isdir(parked_rep):
+            if not os.path.isdir(myrepos): os.makedirs(myrepos)
+            os.rename(parked_rep, self.rep_dir(rep_name))
+
+class WorkspacePool(object):
+    def __init__(self, parent, prefix, build_rep_prefix, execute, log):
+        self.parent = parent
+        self.prefix = prefix
+        self.build_rep_prefix = build_rep_prefix
+        self.execute = execute
+        self.log = log
+        self.lock = threading.Lock()
+        self.idle = {} # internal branch -> idle workspaces
+        self.count = {} # internal branch -> number of workspaces
+
+    def acquire(self, internal_branch):
+        """Obtain an idle workspace for the given internal branch, creating one
+        if all of them are in use."""
+        with self.lock:
+            idle = self.idle.setdefault(internal_branch, [])
+            if idle: return idle.pop(0)
+            slot = self.count.get(internal_branch, 0)
+            self.count[internal_branch] = slot + 1
+        suffix = "" if slot == 0 else ".%d" % slot
+        name = "%s-%s%s.hg" % (self.prefix, internal_branch, suffix)
+        build_rep = "%s/%s/build.hg" % (self.build_rep_prefix, internal_branch)
+        workspace = Workspace(self.parent, name, build_rep, self.execute, self.log)
+        workspace.internal_branch = internal_branch
+        return workspace
+
+    def release(self, workspace):
+        with self.lock:
+            self.idle[workspace.internal_branch].append(workspace)
+            self.idle[workspace.internal_branch].sort(key=lambda w: w.name)